@@ -0,0 +1,340 @@
+# benchmarks for the rating and table code, run with: python benchmark.py [name ...]
+import datetime
+import multiprocessing
+import os
+import random
+import sys
+import time
+import types
+
+import cache
+import gviz_api
+import rating
+
+# ------------------- Synthetic Data ---------------------------------------------------------------------------------
+class SyntheticGame(object):
+    def __init__(self, winner, loser, tie, winner_score, loser_score):
+        self.winner = winner
+        self.loser = loser
+        self.tie = tie
+        self.winner_score = winner_score
+        self.loser_score = loser_score
+
+def SyntheticHistory(numGames, numPlayers, seed=1):
+    rand = random.Random(seed)
+    players = ["player%d@example.com" % i for i in range(numPlayers)]
+    games = []
+    for i in range(numGames):
+        winner = rand.choice(players)
+        loser = rand.choice(players)
+        scoreA = rand.randint(0, 7)
+        scoreB = rand.randint(0, 7)
+        games.append(SyntheticGame(winner, loser, scoreA == scoreB, max(scoreA, scoreB), min(scoreA, scoreB)))
+    return games
+
+def Timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+# ------------------- Replay ----------------------------------------------------------------------------------------
+class LegacyRecord(object):
+    def __init__(self):
+        self.rating = 0
+        self.ratingChange = 0
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.goalsfor = 0
+        self.goalsagainst = 0
+        self.isProvisional = True
+
+    def copy(self):
+        record = LegacyRecord()
+        record.__dict__.update(self.__dict__)
+        return record
+
+# the per game path of UpdateRatingScore, with a dict standing in for the two lookups and two puts
+def LegacyReplay(games):
+    records = {}
+    for game in games:
+        winner = records.setdefault(game.winner, LegacyRecord()).copy()
+        loser = records.setdefault(game.loser, LegacyRecord()).copy()
+
+        loserProtection = winner.isProvisional and not loser.isProvisional
+        if winner.rating == 0:
+            winner.rating = rating.ELO_DEFAULT_RATING
+        if loser.rating == 0:
+            loser.rating = rating.ELO_DEFAULT_RATING
+
+        winnerRatingChange = rating.CalcRatingChange(winner.rating, loser.rating, 1.0 if not game.tie else 0.5, game.winner_score - game.loser_score, False)
+        loserRatingChange = rating.CalcRatingChange(loser.rating, winner.rating, 0.0 if not game.tie else 0.5, game.loser_score - game.winner_score, loserProtection)
+
+        winner.ratingChange = int(winnerRatingChange)
+        winner.rating += winner.ratingChange
+        winner.goalsfor += game.winner_score
+        winner.goalsagainst += game.loser_score
+        if game.tie:
+            winner.draws += 1
+        else:
+            winner.wins += 1
+        winner.isProvisional = winner.wins + winner.draws + winner.losses < rating.PROVISIONAL_NUM_GAMES
+        records[game.winner] = winner
+
+        loser.ratingChange = int(loserRatingChange)
+        loser.rating += loser.ratingChange
+        loser.goalsfor += game.loser_score
+        loser.goalsagainst += game.winner_score
+        if game.tie:
+            loser.draws += 1
+        else:
+            loser.losses += 1
+        loser.isProvisional = loser.wins + loser.draws + loser.losses < rating.PROVISIONAL_NUM_GAMES
+        records[game.loser] = loser
+    return records
+
+def BatchReplay(games):
+    replay = rating.RatingReplay()
+    replay.Replay(games)
+    return replay
+
+def BenchReplay():
+    games = SyntheticHistory(100000, 300)
+    records, legacyTime = Timed(LegacyReplay, games)
+    replay, batchTime = Timed(BatchReplay, games)
+
+    for player, record in records.items():
+        if replay.PlayerStats(player) != dict(record.__dict__):
+            raise AssertionError("replay mismatch for %s" % player)
+
+    print("replay: %d games, %d players" % (len(games), len(records)))
+    print("  per game path  %.3fs" % legacyTime)
+    print("  batch replay   %.3fs  (%.0f games/s)" % (batchTime, len(games) / batchTime))
+    print("  final ratings identical")
+
+# ------------------- Standings Cache -------------------------------------------------------------------------------
+# stands in for Ladder.get's uncached path, a datastore fetch followed by building the table json
+def SyntheticStandings(numPlayers, fetchLatency):
+    time.sleep(fetchLatency)
+    rows = []
+    for i in range(numPlayers):
+        rows.append("{c:[{v:%d},{v:%d},{v:'player%d@example.com'},{v:%d}]}" % (i + 1, 2000 - i, i, i % 7))
+    return "{cols: [],rows: [%s]}" % ",".join(rows)
+
+def BenchStandingsCache():
+    numRequests = 2000
+    reportEvery = 50
+    fetchLatency = 0.002
+    compute = lambda: SyntheticStandings(500, fetchLatency)
+
+    # two instances sharing one memcache, requests alternate between them
+    client = cache.LocalMemcache()
+    instances = [cache.VersionedCache(client), cache.VersionedCache(client)]
+
+    start = time.time()
+    for i in range(numRequests):
+        compute()
+    uncachedTime = time.time() - start
+
+    start = time.time()
+    for i in range(numRequests):
+        if i % reportEvery == 0:
+            instances[0].BumpVersion('fifadev')
+        instances[i % 2].Get('fifadev', 'standings', compute)
+    cachedTime = time.time() - start
+
+    localHits = sum([instance.localHits for instance in instances])
+    memcacheHits = sum([instance.memcacheHits for instance in instances])
+    misses = sum([instance.misses for instance in instances])
+    print("standings cache: %d requests, a report every %d" % (numRequests, reportEvery))
+    print("  hits: %d local, %d memcache, %d misses (hit ratio %.3f)" % (localHits, memcacheHits, misses, float(localHits + memcacheHits) / numRequests))
+    print("  uncached %.3fms/request, cached %.3fms/request" % (uncachedTime * 1000 / numRequests, cachedTime * 1000 / numRequests))
+
+# ------------------- Rank Index ------------------------------------------------------------------------------------
+# rank lookups against sorting every rating, as building the standings does
+def BenchRankIndex():
+    numPlayers = 100000
+    numSortedLookups = 20
+    numLookups = 2000
+    rand = random.Random(1)
+    ratings = [rand.randint(1000, 2200) for i in range(numPlayers)]
+    index = rating.RankIndex.FromRatings(ratings)
+
+    start = time.time()
+    for i in range(numSortedLookups):
+        ranked = sorted(ratings, reverse=True)
+        if ranked.index(ratings[i]) + 1 != index.Rank(ratings[i]):
+            raise AssertionError("rank mismatch for rating %d" % ratings[i])
+    sortTime = (time.time() - start) / numSortedLookups
+
+    start = time.time()
+    for i in range(numLookups):
+        index.Move(ratings[i], ratings[i] + 10)
+        index.Rank(ratings[i])
+        index.RatingAt(i + 1)
+    indexTime = (time.time() - start) / numLookups
+
+    print("rank index: %d players" % numPlayers)
+    print("  sorted lookup  %.3fms" % (sortTime * 1000))
+    print("  index move, rank and rating at rank  %.3fms" % (indexTime * 1000))
+
+# ------------------- Table Sorting ---------------------------------------------------------------------------------
+SORT_ORDER = [("rating", "desc"), ("name", "asc"), ("gp", "desc")]
+
+# the cmp based sort _PreparedData used before, comparing the keys one after the other
+def LegacySortRows(rows, order_by):
+    sortKeys = [(key, direction == "asc" and 1 or -1) for key, direction in order_by]
+    def SortCmpFunc(row1, row2):
+        for key, ascMult in sortKeys:
+            cmpResult = ascMult * cmp(row1.get(key), row2.get(key))
+            if cmpResult:
+                return cmpResult
+        return 0
+    return sorted(rows, cmp=SortCmpFunc)
+
+def SyntheticTable(numRows, seed=1, columnar=False):
+    rand = random.Random(seed)
+    table = gviz_api.DataTable([("name", "string"), ("rating", "number"), ("gp", "number")], columnar=columnar)
+    table.LoadData(["player%d@example.com" % rand.randint(0, numRows), rand.randint(1000, 2000), rand.randint(0, 50)] for i in range(numRows))
+    return table
+
+def BenchTableSort():
+    for numRows in (10000, 100000, 1000000):
+        table = SyntheticTable(numRows)
+        rows = table._PreparedData()
+        legacyRows, legacyTime = Timed(LegacySortRows, rows, SORT_ORDER)
+        keyRows, keyTime = Timed(table._PreparedData, SORT_ORDER)
+        if keyRows != legacyRows:
+            raise AssertionError("sort mismatch at %d rows" % numRows)
+        print("table sort: %d rows, order %s" % (numRows, SORT_ORDER))
+        print("  cmp function   %.3fs" % legacyTime)
+        print("  key passes     %.3fs  (%.1fx)" % (keyTime, legacyTime / keyTime))
+
+# ------------------- Columnar Tables -------------------------------------------------------------------------------
+def ResidentBytes():
+    return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+# each table is built in a fresh process, so memory freed by the other one is not counted
+def TableMemory(numRows, columnar, results):
+    before = ResidentBytes()
+    table = SyntheticTable(numRows, columnar=columnar)
+    results.put(ResidentBytes() - before)
+
+def BenchColumnarTable():
+    numRows = 500000
+    results = multiprocessing.Queue()
+    memory = {}
+    for columnar in (False, True):
+        process = multiprocessing.Process(target=TableMemory, args=(numRows, columnar, results))
+        process.start()
+        memory[columnar] = results.get()
+        process.join()
+
+    rowTable = SyntheticTable(100000)
+    columnTable = SyntheticTable(100000, columnar=True)
+    rowJson, rowTime = Timed(rowTable.ToJSon, None, SORT_ORDER)
+    columnJson, columnTime = Timed(columnTable.ToJSon, None, SORT_ORDER)
+    if rowJson != columnJson:
+        raise AssertionError("columnar json differs")
+
+    print("columnar table: %d rows of (string, number, number)" % numRows)
+    print("  row dicts  %.1fMB" % (memory[False] / 1048576.0))
+    print("  columnar   %.1fMB  (%.0f%% less)" % (memory[True] / 1048576.0, 100.0 - 100.0 * memory[True] / memory[False]))
+    print("  sorted json of 100000 rows: row dicts %.3fs, columnar %.3fs, output identical" % (rowTime, columnTime))
+
+# ------------------- Value Encoders --------------------------------------------------------------------------------
+# the shapes of the standings and rating history tables
+STANDINGS_SHAPE = [("name", "string")] + [(name, "number") for name in ("rank", "wins", "losses", "draws", "gp", "gf", "ga", "gd", "rating", "+-")]
+HISTORY_SHAPE = [("date", "datetime"), ("rating", "number"), ("opponent", "string"), ("delta", "number")]
+
+# the if/elif dispatch of SingleValueToJS before the encoders were compiled per column
+def LegacySingleValueToJS(value, valueType):
+    if isinstance(value, tuple):
+        if len(value) != 2:
+            raise gviz_api.DataTableException("Wrong format for value and formatting - %s." % str(value))
+        if not isinstance(value[1], types.StringTypes):
+            raise gviz_api.DataTableException("Formatted value is not string, given %s." % type(value[1]))
+        jsValue = LegacySingleValueToJS(value[0], valueType)
+        if jsValue == "null":
+            raise gviz_api.DataTableException("An empty cell can not have formatting.")
+        return (jsValue, gviz_api.DataTable._EscapeValue(value[1]))
+    if value is None:
+        return "null"
+    if valueType == "boolean":
+        if value:
+            return "true"
+        return "false"
+    elif valueType == "number":
+        if isinstance(value, (int, long, float)):
+            return str(value)
+        raise gviz_api.DataTableException("Wrong type %s when expected number" % type(value))
+    elif valueType == "string":
+        if isinstance(value, tuple):
+            raise gviz_api.DataTableException("Tuple is not allowed as string value.")
+        return gviz_api.DataTable._EscapeValue(value)
+    elif valueType == "date":
+        if not isinstance(value, (datetime.date, datetime.datetime)):
+            raise gviz_api.DataTableException("Wrong type %s when expected date" % type(value))
+        return "new Date(%d,%d,%d)" % (value.year, value.month - 1, value.day)
+    elif valueType == "timeofday":
+        if not isinstance(value, (datetime.time, datetime.datetime)):
+            raise gviz_api.DataTableException("Wrong type %s when expected time" % type(value))
+        return "[%d,%d,%d]" % (value.hour, value.minute, value.second)
+    elif valueType == "datetime":
+        if not isinstance(value, datetime.datetime):
+            raise gviz_api.DataTableException("Wrong type %s when expected datetime" % type(value))
+        return "new Date(%d,%d,%d,%d,%d,%d)" % (value.year, value.month - 1, value.day, value.hour, value.minute, value.second)
+    raise gviz_api.DataTableException("Unsupported type %s" % valueType)
+
+# every cell of the rows through the type dispatch, looking the column type up per cell as ToJSon did
+def LegacyEncodeRows(table, rows):
+    colDict = dict([(col["id"], col) for col in table.columns])
+    columnsOrder = [col["id"] for col in table.columns]
+    return [[LegacySingleValueToJS(value, colDict[col]["type"]) for col, value in zip(columnsOrder, row)] for row in rows]
+
+def EncodeRows(table, rows):
+    encoders = table._Encoders([col["id"] for col in table.columns])
+    return [[encoder(value) for encoder, value in zip(encoders, row)] for row in rows]
+
+def SyntheticCell(rand, valueType, i):
+    if valueType == "string":
+        return "player%d@example.com" % i
+    if valueType == "datetime":
+        return datetime.datetime(2009, 1, 1) + datetime.timedelta(seconds=rand.randint(0, 10 ** 8))
+    return rand.randint(-50, 2000)
+
+def BenchValueEncoders():
+    numRows = 100000
+    rand = random.Random(1)
+    for name, shape in (("standings", STANDINGS_SHAPE), ("history", HISTORY_SHAPE)):
+        table = gviz_api.DataTable(shape)
+        table.LoadData([[SyntheticCell(rand, valueType, i) for colId, valueType in shape] for i in range(numRows)])
+        rows = list(table._PreparedValues([col["id"] for col in table.columns]))
+        numCells = numRows * len(shape)
+
+        legacyCells, legacyTime = Timed(LegacyEncodeRows, table, rows)
+        cells, encodeTime = Timed(EncodeRows, table, rows)
+        if cells != legacyCells:
+            raise AssertionError("encoded %s cells differ" % name)
+
+        print("value encoders: %d %s rows of %s" % (numRows, name, ", ".join([valueType for colId, valueType in shape])))
+        print("  type dispatch      %.0f cells/s" % (numCells / legacyTime))
+        print("  compiled encoders  %.0f cells/s  (%.1fx)" % (numCells / encodeTime, legacyTime / encodeTime))
+
+        json, jsonTime = Timed(table.ToJSon)
+        strictJson, strictTime = Timed(table.ToJSon, None, (), True)
+        print("  ToJSon %.0f cells/s, strict ToJSon %.0f cells/s" % (numCells / jsonTime, numCells / strictTime))
+
+BENCHMARKS = {
+    'columnar': BenchColumnarTable,
+    'encode': BenchValueEncoders,
+    'rank': BenchRankIndex,
+    'replay': BenchReplay,
+    'sort': BenchTableSort,
+    'standings': BenchStandingsCache,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
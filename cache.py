@@ -0,0 +1,102 @@
+import time
+
+# ------------------- Local Memcache ---------------------------------------------------------------------------------
+# stand-in for google.appengine.api.memcache with the calls the caches here make, for running
+# the caches outside of app engine
+class LocalMemcache(object):
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def get_multi(self, keys):
+        return dict([(key, self.values[key]) for key in keys if key in self.values])
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        if key not in self.values:
+            if initial_value is None:
+                return None
+            self.values[key] = initial_value
+        self.values[key] += delta
+        return self.values[key]
+
+    def delete(self, key):
+        if key in self.values:
+            del self.values[key]
+            return 2
+        return 1
+
+    def flush_all(self):
+        self.values = {}
+        return True
+
+# ------------------- Versioned Cache --------------------------------------------------------------------------------
+# two level cache, a dict in process memory in front of memcache. values are stored under the
+# ladder's current version, so bumping the version invalidates everything cached for that ladder
+# on every instance without having to find and delete the entries
+class VersionedCache(object):
+
+    def __init__(self, client, maxLocalEntries=100):
+        self.client = client
+        self.maxLocalEntries = maxLocalEntries
+        self.local = {}
+        self.localHits = 0
+        self.memcacheHits = 0
+        self.misses = 0
+
+    def VersionKey(self, ladder):
+        return "version:%s" % ladder
+
+    def GetVersion(self, ladder):
+        version = self.client.get(self.VersionKey(ladder))
+        if version is None:
+            # an evicted version restarts from the clock, never from a number used before
+            self.client.add(self.VersionKey(ladder), int(time.time() * 1000))
+            version = self.client.get(self.VersionKey(ladder))
+        return version
+
+    def BumpVersion(self, ladder):
+        if self.client.incr(self.VersionKey(ladder)) is None:
+            self.client.add(self.VersionKey(ladder), int(time.time() * 1000))
+
+    # the cached value of 'name', or compute() stored at both levels when it is not cached
+    def Get(self, ladder, name, compute, version=None):
+        if version is None:
+            version = self.GetVersion(ladder)
+        key = "%s:%s:%s" % (name, ladder, version)
+
+        value = self.local.get(key)
+        if value is not None:
+            self.localHits += 1
+            return value
+
+        value = self.client.get(key)
+        if value is not None:
+            self.memcacheHits += 1
+        else:
+            self.misses += 1
+            value = compute()
+            self.client.set(key, value)
+
+        if len(self.local) >= self.maxLocalEntries:
+            self.local = {}
+        self.local[key] = value
+        return value
+
+    def HitRatio(self):
+        lookups = self.localHits + self.memcacheHits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.localHits + self.memcacheHits) / lookups
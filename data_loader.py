@@ -79,5 +79,9 @@ class UserLoader(bulkloader.Loader):
                                   ('ratingChange', int)
                                  ])
 
+  # records are keyed by ladder and email, as in UserRecordKeyName
+  def generate_key(self, i, values):
+    return "%s:%s" % (values[0], values[1])
+
 exporters = [CommentExporter, GameExporter, UserExporter]
 loaders = [GameLoader, UserLoader]
@@ -1,24 +1,67 @@
+import bisect
+import cache
 import cgi
+import datetime
+import hashlib
 import os
 import gviz_api
+import rating
 import math
 import logging
 import time
+import traceback
+
+try:
+    import json as simplejson
+except ImportError:
+    from django.utils import simplejson
 
 from google.appengine.ext.webapp import template
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.ext import db
 
-ELO_DEFAULT_RATING = 1500
-ELO_MATCH_WEIGHT = 50.0
-ELO_DIVIDE_FACTOR = 400.0
-PROVISIONAL_PROTECTION = 2.0
-PROVISIONAL_NUM_GAMES = 6
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
 
 ladder_name = "fifadev"
 
+MAX_BATCH_SIZE = 500
+QUERY_BATCH_SIZE = 500
+CHECKPOINT_INTERVAL = 100
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# a multiple of CHECKPOINT_INTERVAL, so every chunk ends on a checkpoint
+RESIMULATE_CHUNK_SIZE = 500
+RESIMULATE_TASK_URL = '/%s/resimulate/task' % (ladder_name)
+HISTORY_TASK_URL = '/%s/resimulate/history' % (ladder_name)
+USER_GAMES_PAGE_SIZE = 20
+RANK_NEIGHBOURS = 2
+STANDINGS_PAGE_SIZE = 50
+MAX_STANDINGS_PAGE_SIZE = 500
+FEED_PAGE_SIZE = 100
+INGEST_TASK_URL = '/%s/ingest/task' % (ladder_name)
+INGEST_QUEUE = 'ingest'
+INGEST_BATCH_SIZE = 50
+# longest comment or team name a report takes, the limit of a StringProperty
+MAX_REPORT_TEXT_LENGTH = 500
+GLICKO_TASK_URL = '/%s/resimulate/glicko' % (ladder_name)
+# rating.ENGINES names, the engine UserRecord ratings are kept with and the one GlickoRecord is rated by
+RATING_ENGINE = 'elo'
+GLICKO_ENGINE = 'glicko2'
+# GameRecord.derived states
+DERIVED_PENDING = 'pending'
+DERIVED_APPLIED = 'applied'
+DERIVED_REMOVED = 'removed'
+TRANSACTION_RETRIES = 5
+TRANSACTION_BACKOFF = 0.05
+TXN_ATTEMPTS_KEY = 'rating_txn_attempts'
+TXN_RETRIES_KEY = 'rating_txn_retries'
+TXN_FAILURES_KEY = 'rating_txn_failures'
+
 # ------------------- Utility Functions ----------------------------------------------------------------------------------
 # safe conversion from string -> int, 0 if fails
 def int_safe(n):
@@ -28,9 +71,46 @@ def int_safe(n):
         val = 0
     return val
 
+# user records are keyed by ladder and email, so a player's record is a direct key fetch
+def UserRecordKeyName(user):
+    return "%s:%s" % (ladder_name, user.email())
+
+def GetUserRecordKey(user):
+    return db.Key.from_path('UserRecord', UserRecordKeyName(user))
+
 def GetUserRecord(user):
-    user = UserRecord.gql("WHERE user = :1", user).get()
-    return user
+    return UserRecord.get_by_key_name(UserRecordKeyName(user))
+
+# iterate over every result of a query, fetched lazily in cursor paged batches so memory stays bounded
+def IterQuery(query, batchSize=QUERY_BATCH_SIZE):
+    while True:
+        batch = query.fetch(batchSize)
+        for entity in batch:
+            yield entity
+        if len(batch) < batchSize:
+            return
+        query.with_cursor(query.cursor())
+
+# db.put in chunks the datastore accepts in a single batch call
+def PutBatched(entities):
+    for i in xrange(0, len(entities), MAX_BATCH_SIZE):
+        db.put(entities[i:i + MAX_BATCH_SIZE])
+
+# load the comments of all the games with one batched get and attach them to the games
+def PrefetchComments(games):
+    keys = []
+    for game in games:
+        if game.count_comments():
+            keys.extend(game.comments)
+    comments = {}
+    if keys:
+        comments = dict(zip(keys, db.get(keys)))
+    for game in games:
+        game.comment_records = [comments[key] for key in game.comments if comments.get(key) is not None]
+
+# date in the format of HTTP headers, datastore dates are UTC
+def HttpDate(date):
+    return date.strftime('%a, %d %b %Y %H:%M:%S GMT')
 
 def GetCurrentLadder(self):
     return self.request.path
@@ -52,9 +132,37 @@ class GameRecord(db.Model):
     winner_team = db.StringProperty()
     loser_team = db.StringProperty()
     comments = db.ListProperty(db.Key)
-
+    # winner and loser, so a player's games are one query ordered by date
+    participants = db.ListProperty(users.User)
+    num_comments = db.IntegerProperty()
+    # rating ledger, see rating.LEDGER_FIELDS
+    winner_rating_before = db.IntegerProperty(indexed=False)
+    winner_rating_after = db.IntegerProperty(indexed=False)
+    winner_change_before = db.IntegerProperty(indexed=False)
+    winner_provisional_before = db.BooleanProperty(indexed=False)
+    winner_provisional_after = db.BooleanProperty(indexed=False)
+    loser_rating_before = db.IntegerProperty(indexed=False)
+    loser_rating_after = db.IntegerProperty(indexed=False)
+    loser_change_before = db.IntegerProperty(indexed=False)
+    loser_provisional_before = db.BooleanProperty(indexed=False)
+    loser_provisional_after = db.BooleanProperty(indexed=False)
+    winner_games_after = db.IntegerProperty(indexed=False)
+    loser_games_after = db.IntegerProperty(indexed=False)
+    # whether the records derived from the ledger (see ApplyDerivedRecords) hold the game, one of
+    # DERIVED_PENDING, DERIVED_APPLIED or DERIVED_REMOVED. games stored before it existed have None, applied
+    derived = db.StringProperty()
+
+    # comments attached by PrefetchComments, or fetched in one batch
     def get_comments(self):
-        return [ db.get( comment ) for comment in self.comments ]
+        if not hasattr(self, 'comment_records'):
+            PrefetchComments([self])
+        return self.comment_records
+
+    # games stored before the count existed have None
+    def count_comments(self):
+        if self.num_comments is None:
+            return len(self.comments)
+        return self.num_comments
 
 class UserRecord(db.Model):
     ladder = db.StringProperty()
@@ -70,134 +178,1124 @@ class UserRecord(db.Model):
     isProvisional = db.BooleanProperty()
 
     @staticmethod
-    def create_UserRecord():
-        return UserRecord(rating = 0, ratingChange = 0, wins = 0, draws = 0, losses = 0, goalsfor = 0, goalsagainst = 0, isProvisional = True)
+    def create_UserRecord(user):
+        return UserRecord(key_name = UserRecordKeyName(user), ladder = ladder_name, user = user,
+                          rating = 0, ratingChange = 0, wins = 0, draws = 0, losses = 0, goalsfor = 0, goalsagainst = 0, isProvisional = True)
 
 
 class LadderRecord(db.Model):
     ladder = db.StringProperty()
     date = db.DateTimeProperty(auto_now_add=True)
 
-# ------------------- Elo Rating Functions ---------------------------------------------------------------------------
-# based on formula taken from World Football Elo Rating System at eloratings.net
-#       Rn = Ro + K x (W - We)
-# where Rn is the new rating
-#       Ro is the old (pre-match) rating
-#       K is match weight
-#       W is result of game (1 for a win, 0.5 for a draw, and 0 for a loss)
-#       We is expected Result
-#
-def CalcExpectedResult(playerRating, opponentRating):
-    expectedResult = 1.0 / (1.0 + pow(10, (opponentRating - playerRating) / ELO_DIVIDE_FACTOR ))
-    return expectedResult
-
-def CalcMatchWeight(goalDifference):
-    weight = ELO_MATCH_WEIGHT
-    if goalDifference >= 4:
-        weight *= 1.75 + (goalDifference - 3) / 8.0
-    elif goalDifference >= 3:
-        weight *= 1.75
-    elif goalDifference >= 2:
-        weight *= 1.5
-    return weight
-
-def CalcRatingChange(playerRating, opponentRating, result, goalDifference, isProtected):
-
-    protection = 1.0
-    if( isProtected ):
-        protection = PROVISIONAL_PROTECTION
-
-    matchWeight = CalcMatchWeight(goalDifference)
-    expectedResult = CalcExpectedResult(playerRating, opponentRating)
-    resultDiff = result - expectedResult
-    ratingChange = (resultDiff * matchWeight) / protection
-
-    #logging.debug("Rating Calc Input: pr:%d or:%d result:%.2f, gd:%d", playerRating, opponentRating, result, goalDifference)
-    #logging.debug("Rating Calc Output: mw:%.2f er:%.2f rc:%.2f", matchWeight, expectedResult, ratingChange)
-    return ratingChange
-
-def UpdateRatingScore(game):
-    winner = GetUserRecord( game.winner )
-    loser = GetUserRecord( game.loser )
-
-    if winner.isProvisional and not loser.isProvisional:
-        winnerProtection = False
-        loserProtection = True
-    else:
-        winnerProtection = False
-        loserProtection = False
-
-    if winner.rating == 0:
-        winner.rating = ELO_DEFAULT_RATING
-    if loser.rating == 0:
-        loser.rating = ELO_DEFAULT_RATING
-
-    #logging.debug("Rating Calc: winner:%s loser:%s", game.winner, game.loser)
-    winnerRatingChange = CalcRatingChange(winner.rating, loser.rating, 1.0 if not game.tie else 0.5, game.winner_score - game.loser_score, winnerProtection)
-    loserRatingChange = CalcRatingChange(loser.rating, winner.rating, 0.0 if not game.tie else 0.5, game.loser_score - game.winner_score, loserProtection)
-
-    winner.ratingChange = int(winnerRatingChange)
-    winner.rating += winner.ratingChange
-    winner.goalsfor += game.winner_score
-    winner.goalsagainst += game.loser_score
-    if( game.tie ):
-        winner.draws += 1
-    else:
-        winner.wins += 1
-    numWinnerGames = winner.wins + winner.draws + winner.losses
-    winner.isProvisional = True if numWinnerGames < PROVISIONAL_NUM_GAMES else False
-    winner.put()
-
-    loser.ratingChange = int(loserRatingChange)
-    loser.rating += loser.ratingChange
-    loser.goalsfor += game.loser_score
-    loser.goalsagainst += game.winner_score
-    if( game.tie ):
-        loser.draws += 1
-    else:
-        loser.losses += 1
-    numLoserGames = loser.wins + loser.draws + loser.losses
-    loser.isProvisional = True if numLoserGames < PROVISIONAL_NUM_GAMES else False
-    loser.put()
+# a player's rating after each game, appended as games are applied. keyed like UserRecord
+class RatingHistory(db.Model):
+    ladder = db.StringProperty()
+    user = db.UserProperty()
+    dates = db.ListProperty(datetime.datetime, indexed=False)
+    ratings = db.ListProperty(int, indexed=False)
+    opponents = db.ListProperty(users.User, indexed=False)
+    deltas = db.ListProperty(int, indexed=False)
+
+    @staticmethod
+    def create_RatingHistory(user):
+        return RatingHistory(key_name = UserRecordKeyName(user), ladder = ladder_name, user = user)
+
+    # entries stay in date order, a game applied late goes in at its place
+    def append(self, date, rating, opponent, delta):
+        position = bisect.bisect_right(self.dates, date)
+        self.dates.insert(position, date)
+        self.ratings.insert(position, rating)
+        self.opponents.insert(position, opponent)
+        self.deltas.insert(position, delta)
+
+    # drop the entry of the game played at 'date'
+    def remove(self, date):
+        if date in self.dates:
+            position = self.dates.index(date)
+            del self.dates[position]
+            del self.ratings[position]
+            del self.opponents[position]
+            del self.deltas[position]
+
+    # drop the entries from 'date' on
+    def truncate(self, date):
+        keep = len([entryDate for entryDate in self.dates if entryDate < date])
+        del self.dates[keep:]
+        del self.ratings[keep:]
+        del self.opponents[keep:]
+        del self.deltas[keep:]
+
+# the record between two players, counted from the first player's side. keyed by the pair in email order
+class HeadToHead(db.Model):
+    ladder = db.StringProperty()
+    players = db.ListProperty(users.User)
+    wins = db.IntegerProperty(default=0)
+    draws = db.IntegerProperty(default=0)
+    losses = db.IntegerProperty(default=0)
+    goalsfor = db.IntegerProperty(default=0)
+    goalsagainst = db.IntegerProperty(default=0)
 
-# recalculate the rating score for all players from the beginning
-def RecalcRatingScores():
-    logging.debug("Recalculating all ratings scores")
+    @staticmethod
+    def create_HeadToHead(playerA, playerB):
+        return HeadToHead(key_name = HeadToHeadKeyName(playerA, playerB), ladder = ladder_name, players = HeadToHeadPlayers(playerA, playerB))
 
-    # get games oldest first
-    gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).order('date')
-    games = gameRecord_query.fetch(1000)
+    # add (sign 1) or remove (sign -1) a game between the two players
+    def apply(self, game, sign=1):
+        if game.winner == self.players[0]:
+            goalsfor, goalsagainst = game.winner_score, game.loser_score
+        else:
+            goalsfor, goalsagainst = game.loser_score, game.winner_score
+        if game.tie:
+            self.draws += sign
+        elif game.winner == self.players[0]:
+            self.wins += sign
+        else:
+            self.losses += sign
+        self.goalsfor += sign * goalsfor
+        self.goalsagainst += sign * goalsagainst
+
+    # the record from 'player's side
+    def stats_for(self, player):
+        if player == self.players[0]:
+            return {'wins': self.wins, 'draws': self.draws, 'losses': self.losses, 'goalsfor': self.goalsfor, 'goalsagainst': self.goalsagainst}
+        return {'wins': self.losses, 'draws': self.draws, 'losses': self.wins, 'goalsfor': self.goalsagainst, 'goalsagainst': self.goalsfor}
+
+# the ladder's rank index, a rating.RankIndex tree over the rating of every rated player. keyed by ladder
+class RankIndexRecord(db.Model):
+    ladder = db.StringProperty()
+    tree = db.ListProperty(int, indexed=False)
 
-    # reset all users to default rating
-    userRecord_query = UserRecord.all().filter("ladder =", ladder_name)
-    userRecords = userRecord_query.fetch(1000)
+    @staticmethod
+    def create_RankIndexRecord(index):
+        return RankIndexRecord(key_name = ladder_name, ladder = ladder_name, tree = index.tree)
+
+    def get_index(self):
+        return rating.RankIndex(self.tree)
+
+    def set_index(self, index):
+        self.tree = index.tree
+
+# every player's stats as of the game played at 'date', the numGames'th game of the ladder
+class RatingCheckpoint(db.Model):
+    ladder = db.StringProperty()
+    date = db.DateTimeProperty()
+    numGames = db.IntegerProperty()
+    players = db.ListProperty(users.User, indexed=False)
+    rating = db.ListProperty(int, indexed=False)
+    ratingChange = db.ListProperty(int, indexed=False)
+    wins = db.ListProperty(int, indexed=False)
+    draws = db.ListProperty(int, indexed=False)
+    losses = db.ListProperty(int, indexed=False)
+    goalsfor = db.ListProperty(int, indexed=False)
+    goalsagainst = db.ListProperty(int, indexed=False)
+    isProvisional = db.ListProperty(bool, indexed=False)
+
+    @staticmethod
+    def create_RatingCheckpoint(replay, date, numGames):
+        checkpoint = RatingCheckpoint(key_name = "%s:%d" % (ladder_name, numGames), ladder = ladder_name, date = date, numGames = numGames)
+        for name, value in replay.Snapshot().items():
+            setattr(checkpoint, name, value)
+        checkpoint.isProvisional = [bool(value) for value in checkpoint.isProvisional]
+        return checkpoint
+
+    def get_replay(self):
+        snapshot = dict([(name, getattr(self, name)) for name in rating.STAT_COLUMNS])
+        snapshot['players'] = self.players
+        return rating.GetEngine(RATING_ENGINE).NewReplay(snapshot)
+
+# ------------------- Rating Updates ---------------------------------------------------------------------------------
+def GetRecordStats(userRecord):
+    return dict([(name, getattr(userRecord, name) or 0) for name in rating.STAT_COLUMNS])
+
+def SetRecordStats(userRecord, stats):
+    for name, value in stats.items():
+        setattr(userRecord, name, value)
+
+# a replay holding the current stats of the given records
+def LoadReplay(userRecords):
+    replay = rating.GetEngine(RATING_ENGINE).NewReplay()
     for userRecord in userRecords:
-        userRecord.rating = 0
-        userRecord.wins = 0
-        userRecord.draws = 0
-        userRecord.losses = 0
-        userRecord.goalsfor = 0
-        userRecord.goalsagainst = 0
-        userRecord.isProvisional = True
+        replay.AddPlayer(userRecord.user, **GetRecordStats(userRecord))
+    return replay
+
+# copy the replay stats of 'players' onto their records, creating records for players who have none yet
+def GetReplayRecords(replay, userRecords, players):
+    recordsByUser = dict([(userRecord.user, userRecord) for userRecord in userRecords])
+    records = []
+    for player in players:
+        userRecord = recordsByUser.get(player)
+        if userRecord is None:
+            userRecord = UserRecord.create_UserRecord(player)
+            recordsByUser[player] = userRecord
+        SetRecordStats(userRecord, replay.PlayerStats(player))
+        records.append(userRecord)
+    return records
+
+def GetRankIndexKey():
+    return db.Key.from_path('RankIndexRecord', ladder_name)
+
+# the (before, after) ratings a game moves in the rank index, a self reported game only moves the loser side
+def GetRankMoves(game):
+    moves = [(game.loser_rating_before, game.loser_rating_after)]
+    if game.winner != game.loser:
+        moves.append((game.winner_rating_before, game.winner_rating_after))
+    return moves
+
+# move the players of 'game' in the rank index, undoing the game when 'undo' is set. only rated players
+# are in the index, a player enters it with their first game and leaves it when that game is undone
+def ApplyRankMoves(indexRecord, game, undo=False):
+    index = indexRecord.get_index()
+    for before, after in GetRankMoves(game):
+        if undo:
+            before, after = after, before
+        if before and after:
+            index.Move(before, after)
+        elif before:
+            index.Add(before, -1)
+        elif after:
+            index.Add(after)
+    indexRecord.set_index(index)
+
+def RebuildRankIndex(ratings):
+    index = rating.RankIndex.FromRatings([playerRating for playerRating in ratings if playerRating])
+    RankIndexRecord.create_RankIndexRecord(index).put()
+    return index
+
+def GetRankIndex():
+    indexRecord = RankIndexRecord.get_by_key_name(ladder_name)
+    if indexRecord is None:
+        # the records already hold the ratings of pending games, their other derived records go first
+        ApplyPendingDerivedRecords()
+        return RebuildRankIndex([userRecord.rating or 0 for userRecord in IterQuery(UserRecord.all().filter("ladder =", ladder_name))])
+    return indexRecord.get_index()
+
+# the players at standings positions start .. start + count - 1. the index gives the rating at 'start',
+# so the query only skips the players sharing that rating who rank above it
+def GetPlayersByRank(start, count, index=None):
+    if index is None:
+        index = GetRankIndex()
+    startRating = index.RatingAt(start)
+    if startRating is None:
+        return []
+    skip = start - 1 - index.CountAbove(startRating)
+    query = UserRecord.all().filter("ladder =", ladder_name).filter("rating <=", startRating).order('-rating')
+    return query.fetch(count, skip)
+
+def HeadToHeadPlayers(playerA, playerB):
+    if playerB.email() < playerA.email():
+        return [playerB, playerA]
+    return [playerA, playerB]
+
+def HeadToHeadKeyName(playerA, playerB):
+    first, second = HeadToHeadPlayers(playerA, playerB)
+    return "%s:%s:%s" % (ladder_name, first.email(), second.email())
+
+# None for a self reported game, which counts in no head to head record
+def GetHeadToHeadKey(game):
+    if game.winner == game.loser:
+        return None
+    return db.Key.from_path('HeadToHead', HeadToHeadKeyName(game.winner, game.loser))
+
+# move games between head to head records, e.g. an edited game is removed as it was and added as it is now
+def ChangeHeadToHead(removed, added):
+    keys = []
+    for game in removed + added:
+        key = GetHeadToHeadKey(game)
+        if key is not None and key not in keys:
+            keys.append(key)
+    if not keys:
+        return
+
+    def txn():
+        records = dict(zip(keys, db.get(keys)))
+        for game, sign in [(game, -1) for game in removed] + [(game, 1) for game in added]:
+            key = GetHeadToHeadKey(game)
+            if key is None:
+                continue
+            if records[key] is None:
+                records[key] = HeadToHead.create_HeadToHead(game.winner, game.loser)
+            records[key].apply(game, sign)
+        db.put(records.values())
+
+    RunRatingTransaction(txn)
+
+# recount every head to head record of the ladder from 'games'
+def RebuildHeadToHead(games):
+    records = {}
+    for record in IterQuery(HeadToHead.all().filter("ladder =", ladder_name)):
+        record.wins = record.draws = record.losses = record.goalsfor = record.goalsagainst = 0
+        records[record.key().name()] = record
+
+    for game in games:
+        if game.winner == game.loser:
+            continue
+        keyName = HeadToHeadKeyName(game.winner, game.loser)
+        record = records.get(keyName)
+        if record is None:
+            record = records[keyName] = HeadToHead.create_HeadToHead(game.winner, game.loser)
+        record.apply(game)
+
+    PutBatched(records.values())
+
+def GetRatingHistoryKey(user):
+    return db.Key.from_path('RatingHistory', UserRecordKeyName(user))
+
+# the history entries a game adds, (player, date, rating, opponent, delta), taken from its ledger
+def GetHistoryEntries(game):
+    sides = []
+    if game.winner != game.loser:
+        sides.append((game.winner, game.winner_rating_before, game.winner_rating_after, game.loser))
+    sides.append((game.loser, game.loser_rating_before, game.loser_rating_after, game.winner))
+    return [(player, game.date, after, opponent, rating.LedgerChange(before, after)) for player, before, after, opponent in sides]
+
+# rebuild the history of 'players' from the ledgers of 'games', which must be every game of those players
+# from 'since' on. with 'since' None the histories are rebuilt from scratch
+def RebuildRatingHistory(games, players=None, since=None):
+    histories = {}
+    if players is not None:
+        for player, history in zip(players, db.get([GetRatingHistoryKey(player) for player in players])):
+            if history is None:
+                history = RatingHistory.create_RatingHistory(player)
+            if since is None:
+                history.truncate(datetime.datetime.max)
+            else:
+                history.truncate(since)
+            histories[player] = history
+
+    for game in games:
+        if not rating.HasLedger(game):
+            continue
+        for player, date, playerRating, opponent, delta in GetHistoryEntries(game):
+            history = histories.get(player)
+            if history is None:
+                if players is not None:
+                    continue
+                history = histories[player] = RatingHistory.create_RatingHistory(player)
+            history.append(date, playerRating, opponent, delta)
+
+    PutBatched(histories.values())
+
+# rating updates run as a cross group transaction over both players and the game. conflicts are
+# retried here instead of inside the datastore call, so attempts and retries can be counted
+def RunRatingTransaction(function, *args):
+    options = db.create_transaction_options(xg=True, retries=0)
+    memcache.incr(TXN_ATTEMPTS_KEY, initial_value=0)
+    for retry in xrange(TRANSACTION_RETRIES + 1):
+        if retry:
+            memcache.incr(TXN_RETRIES_KEY, initial_value=0)
+            time.sleep(TRANSACTION_BACKOFF * 2 ** (retry - 1))
+        try:
+            return db.run_in_transaction_options(options, function, *args)
+        except db.TransactionFailedError:
+            logging.warning("Rating transaction collided, attempt %d of %d", retry + 1, TRANSACTION_RETRIES + 1)
+    memcache.incr(TXN_FAILURES_KEY, initial_value=0)
+    raise db.TransactionFailedError("Rating transaction failed after %d retries" % TRANSACTION_RETRIES)
+
+# counters of rating transactions since the last memcache flush
+def GetTransactionStats():
+    counters = memcache.get_multi([TXN_ATTEMPTS_KEY, TXN_RETRIES_KEY, TXN_FAILURES_KEY])
+    return {'attempts': counters.get(TXN_ATTEMPTS_KEY, 0),
+            'retries': counters.get(TXN_RETRIES_KEY, 0),
+            'failures': counters.get(TXN_FAILURES_KEY, 0)}
+
+# with 'pendingKey' the game comes from the ingestion queue, the pending report is deleted in the same
+# transaction and a report that is already gone is not applied again. the transaction only spans the report,
+# both players and the game, the records derived from the game follow in ApplyDerivedRecords
+def UpdateRatingScore(game, pendingKey=None):
+    winnerKey = GetUserRecordKey( game.winner )
+    loserKey = GetUserRecordKey( game.loser )
+
+    def txn():
+        if pendingKey is not None:
+            if db.get(pendingKey) is None:
+                return False
+            db.delete(pendingKey)
+        winner, loser = db.get([winnerKey, loserKey])
+        if winner is None or loser is None:
+            raise db.BadValueError("Game %s - %s has a player without a record" % (game.winner, game.loser))
+
+        # apply the game to both players, keeping their before/after values on the game
+        replay = LoadReplay([winner, loser])
+        rating.SetLedger(game, replay.ApplyGame(game.winner, game.loser, game.tie, game.winner_score, game.loser_score))
+
+        SetRecordStats(winner, replay.PlayerStats(winner.user))
+        SetRecordStats(loser, replay.PlayerStats(loser.user))
+        game.derived = DERIVED_PENDING
+        entities = [loser, game]
+        if winnerKey != loserKey:
+            entities.append(winner)
+
+        db.put(entities)
+        return True
+
+    applied = RunRatingTransaction(txn)
+    if applied:
+        # the ratings are in, the standings must change even if the derived records fail and wait for
+        # ApplyPendingDerivedRecords
+        InvalidateStandings()
+        ApplyDerivedRecords(game.key())
+    return applied
+
+# the keys of the records derived from a game's ledger: its players' rating histories, their head to
+# head record and the rank index. with the game that is at most five entity groups
+def GetDerivedKeys(game):
+    keys = [GetRatingHistoryKey(game.loser), GetRankIndexKey()]
+    if game.winner != game.loser:
+        keys += [GetRatingHistoryKey(game.winner), GetHeadToHeadKey(game)]
+    return keys
+
+# add a rated game to its derived records. the game's derived state makes this safe to run again, the
+# ingest worker picks up games whose records were not updated after the rating transaction
+def ApplyDerivedRecords(gameKey):
+    def txn():
+        game = db.get(gameKey)
+        if game is None or game.derived not in (DERIVED_PENDING, DERIVED_REMOVED):
+            return False
+        records = dict(zip(GetDerivedKeys(game), db.get(GetDerivedKeys(game))))
+        entities = [game]
+
+        for player, date, playerRating, opponent, delta in GetHistoryEntries(game):
+            history = records[GetRatingHistoryKey(player)] or RatingHistory.create_RatingHistory(player)
+            history.append(date, playerRating, opponent, delta)
+            entities.append(history)
+
+        if game.winner != game.loser:
+            headToHead = records[GetHeadToHeadKey(game)] or HeadToHead.create_HeadToHead(game.winner, game.loser)
+            headToHead.apply(game)
+            entities.append(headToHead)
+
+        # a missing rank index is built from the records on its first read
+        indexRecord = records[GetRankIndexKey()]
+        if indexRecord:
+            ApplyRankMoves(indexRecord, game)
+            entities.append(indexRecord)
+
+        game.derived = DERIVED_APPLIED
+        db.put(entities)
+        return True
+
+    return RunRatingTransaction(txn)
+
+# take a game back out of its derived records, e.g. before it is undone
+def RemoveDerivedRecords(gameKey):
+    def txn():
+        game = db.get(gameKey)
+        if game is None:
+            return False
+        if game.derived in (None, DERIVED_APPLIED):
+            records = dict(zip(GetDerivedKeys(game), db.get(GetDerivedKeys(game))))
+            for player, date, playerRating, opponent, delta in GetHistoryEntries(game):
+                if records[GetRatingHistoryKey(player)]:
+                    records[GetRatingHistoryKey(player)].remove(date)
+            if game.winner != game.loser and records[GetHeadToHeadKey(game)]:
+                records[GetHeadToHeadKey(game)].apply(game, -1)
+            if records[GetRankIndexKey()]:
+                ApplyRankMoves(records[GetRankIndexKey()], game, True)
+            db.put([record for record in records.values() if record is not None])
+        game.derived = DERIVED_REMOVED
+        game.put()
+        return True
+
+    return RunRatingTransaction(txn)
+
+# apply the derived records of games left pending, e.g. by a request that died after its rating transaction,
+# or left removed by an undo that died before the game was deleted
+def ApplyPendingDerivedRecords():
+    games = GameRecord.all().filter("ladder =", ladder_name).filter("derived IN", [DERIVED_PENDING, DERIVED_REMOVED]).fetch(INGEST_BATCH_SIZE)
+    numApplied = 0
+    for game in games:
+        try:
+            if ApplyDerivedRecords(game.key()):
+                numApplied += 1
+        except (db.Timeout, db.TransactionFailedError, db.InternalError):
+            raise
+        except Exception:
+            # logged and left pending, it must not hold up the reports
+            logging.exception("Derived records of game %s could not be applied", game.key().name())
+    if numApplied:
+        InvalidateStandings()
+    return len(games)
+
+# a rebuild of the derived records from every game covers the games still pending, they must not be
+# applied again on top of it
+def MarkPendingDerivedApplied():
+    games = list(IterQuery(GameRecord.all().filter("ladder =", ladder_name).filter("derived =", DERIVED_PENDING)))
+    for game in games:
+        game.derived = DERIVED_APPLIED
+    PutBatched(games)
+
+# the latest checkpoint taken before 'since', None to start from the first game
+def GetStartCheckpoint(since):
+    if since is None:
+        return None
+    return RatingCheckpoint.all().filter("ladder =", ladder_name).filter("date <", since).order('-date').get()
+
+# the replay state at a checkpoint, or a fresh one where every player starts from the default
+# rating and only the last change of their record is carried over
+def GetStartReplay(checkpoint, userRecords):
+    if checkpoint:
+        replay = checkpoint.get_replay()
+    else:
+        replay = rating.GetEngine(RATING_ENGINE).NewReplay()
+    for userRecord in userRecords:
+        if userRecord.user not in replay.slots:
+            replay.AddPlayer(userRecord.user, ratingChange = userRecord.ratingChange or 0)
+    return replay
+
+# checkpoints past the starting point no longer match the history. with 'since' set, the checkpoints
+# taken at or after a changed game are the stale ones
+def DeleteStaleCheckpoints(checkpoint=None, since=None):
+    staleCheckpoint_query = RatingCheckpoint.all(keys_only=True).filter("ladder =", ladder_name)
+    if checkpoint:
+        staleCheckpoint_query.filter("date >", checkpoint.date)
+    elif since:
+        staleCheckpoint_query.filter("date >=", since)
+    staleCheckpoints = list(IterQuery(staleCheckpoint_query))
+    for i in xrange(0, len(staleCheckpoints), MAX_BATCH_SIZE):
+        db.delete(staleCheckpoints[i:i + MAX_BATCH_SIZE])
+
+# replay games on top of a replay that has already seen numGames games, snapshotting every
+# CHECKPOINT_INTERVAL games. returns the new game count, the checkpoints and the games whose ledger changed
+def ReplayGames(replay, games, numGames):
+    checkpoints = []
+    changedGames = []
+    start = 0
+    while start < len(games):
+        end = start + CHECKPOINT_INTERVAL - numGames % CHECKPOINT_INTERVAL
+        numGames += replay.Replay(games[start:end], changedGames)
+        start = end
+        if numGames % CHECKPOINT_INTERVAL == 0:
+            checkpoints.append(RatingCheckpoint.create_RatingCheckpoint(replay, games[start - 1].date, numGames))
+    return numGames, checkpoints, changedGames
+
+# take the next checkpoint once CHECKPOINT_INTERVAL games were ingested after the latest one. the games are
+# replayed from that checkpoint rather than read off the records, and a replay that does not reproduce the
+# stored ledgers (a game missing from the query, or ledgers older than the replay) takes none
+def CheckpointIngestedGames():
+    job = ResimulateJob.get_by_key_name(ladder_name)
+    if job is not None and job.status == 'running':
+        return None
+    checkpoint = RatingCheckpoint.all().filter("ladder =", ladder_name).order('-date').get()
+    gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).order('date')
+    if checkpoint:
+        gameRecord_query.filter("date >", checkpoint.date)
+    games = gameRecord_query.fetch(CHECKPOINT_INTERVAL)
+    if len(games) < CHECKPOINT_INTERVAL:
+        return None
+
+    replay = GetStartReplay(checkpoint, [])
+    numGames, checkpoints, changedGames = ReplayGames(replay, games, checkpoint and checkpoint.numGames or 0)
+    if changedGames or not checkpoints:
+        logging.info("Games after checkpoint at game %d do not replay to their ledgers, no checkpoint taken", checkpoint and checkpoint.numGames or 0)
+        return None
+    PutBatched(checkpoints)
+    return checkpoints[-1]
+
+# roll back the latest game of the ladder from its ledger and delete it. returns None when there is
+# nothing to undo, or when a newer game of either player was applied in the meantime
+def UndoLatestGame():
+    game = GameRecord.all().filter("ladder =", ladder_name).order('-date').get()
+    if game is None:
+        return None
+
+    if not rating.HasLedger(game):
+        db.delete([game.key()] + game.comments)
+        ChangeHeadToHead([game], [])
+        StartResimulateJob(game.date)
+        return game
+
+    winnerKey = GetUserRecordKey( game.winner )
+    loserKey = GetUserRecordKey( game.loser )
+
+    # the derived records come out first in a transaction of their own, and go back in if the game
+    # turns out not to be the latest any more
+    if not RemoveDerivedRecords(game.key()):
+        return None
+
+    def txn():
+        current, winner, loser = db.get([game.key(), winnerKey, loserKey])
+        # the game must still be there, still out of its derived records and still the latest one of both players
+        if current is None or current.derived != DERIVED_REMOVED:
+            return False
+        if not IsLatestGame(loser, game.loser_rating_after, game.loser_games_after):
+            return False
+        if winnerKey != loserKey and not IsLatestGame(winner, game.winner_rating_after, game.winner_games_after):
+            return False
+
+        replay = LoadReplay([winner, loser])
+        replay.UndoGame(game.winner, game.loser, game.tie, game.winner_score, game.loser_score, rating.GetLedger(game))
+        SetRecordStats(winner, replay.PlayerStats(winner.user))
+        SetRecordStats(loser, replay.PlayerStats(loser.user))
+        entities = [loser]
+        if winnerKey != loserKey:
+            entities.append(winner)
+
+        db.put(entities)
+        db.delete(game.key())
+        return True
+
+    try:
+        undone = RunRatingTransaction(txn)
+    except:
+        ApplyDerivedRecords(game.key())
+        raise
+    if not undone:
+        logging.warning("Game %s - %s reported %s is no longer the latest, not undone", game.winner, game.loser, game.date)
+        ApplyDerivedRecords(game.key())
+        return None
+    db.delete(game.comments)
+    DeleteStaleCheckpoints(since = game.date)
+    InvalidateStandings()
+    return game
+
+# whether a player's record still stands as a game's ledger left it. ledgers written before the game count
+# was kept only have the rating to go by
+def IsLatestGame(userRecord, ratingAfter, gamesAfter):
+    if userRecord.rating != ratingAfter:
+        return False
+    return gamesAfter is None or NumGames(userRecord) == gamesAfter
+
+# write a replayed record only if nothing else changed it since its stats were read, 'stats' is None
+# for a record that did not exist then. returns False when it was changed
+def PutRecordIfUnchanged(userRecord, stats):
+    def txn():
+        current = db.get(userRecord.key())
+        if current is None and stats is not None:
+            return False
+        if current is not None and (stats is None or GetRecordStats(current) != stats):
+            return False
         userRecord.put()
+        return True
+    return RunRatingTransaction(txn)
+
+# apply 'values' to a game and replay only the games from it on. the later games are rolled back
+# from their ledgers first, so the replay starts from the players' state before the edited game
+def EditGame(game, values):
+    previous = GameRecord(ladder = game.ladder, winner = game.winner, loser = game.loser, tie = game.tie,
+                          winner_score = game.winner_score, loser_score = game.loser_score)
+    ApplyPendingDerivedRecords()
+    games = [game] + list(IterQuery(GameRecord.all().filter("ladder =", ladder_name).filter("date >", game.date).order('date')))
+    if not [later for later in games if not rating.HasLedger(later)]:
+        userRecords = list(IterQuery(UserRecord.all().filter("ladder =", ladder_name)))
+        readStats = dict([(userRecord.user, GetRecordStats(userRecord)) for userRecord in userRecords])
+        replay = LoadReplay(userRecords)
+        players = set([game.winner, game.loser])
+        for later in reversed(games):
+            replay.UndoGame(later.winner, later.loser, later.tie, later.winner_score, later.loser_score, rating.GetLedger(later))
+            players.update([later.winner, later.loser])
+
+        for name, value in values.items():
+            setattr(game, name, value)
+        players.update([game.winner, game.loser])
+
+        changedGames = []
+        replay.Replay(games, changedGames)
+        if game not in changedGames:
+            changedGames.append(game)
+        PutBatched(changedGames)
+        DeleteStaleCheckpoints(since = game.date)
+
+        # a game applied since the records were read must not be overwritten, the records are written one
+        # by one against what was read and the first one that moved hands the edit to a checkpoint replay
+        for userRecord in GetReplayRecords(replay, userRecords, list(players)):
+            if not PutRecordIfUnchanged(userRecord, readStats.get(userRecord.user)):
+                logging.warning("Record of %s changed during the edit, resimulating", userRecord.user)
+                StartResimulateJob(game.date)
+                return
+        RebuildRatingHistory(games, list(players), game.date)
+        ChangeHeadToHead([previous], [game])
+        RebuildRankIndex(replay.rating)
+        InvalidateStandings()
+    else:
+        # games reported before the ledger existed go through a checkpoint replay
+        for name, value in values.items():
+            setattr(game, name, value)
+        game.put()
+        ChangeHeadToHead([previous], [game])
+        StartResimulateJob(game.date)
+
+# ------------------- Background Resimulation -----------------------------------------------------------------------
+# a resimulation runs as a chain of tasks, each replaying RESIMULATE_CHUNK_SIZE games. the job keeps the
+# query cursor and the game count, and the replay state between chunks is the checkpoint at that count,
+# so a failed chunk is simply run again by the task queue retry
+class ResimulateJob(db.Model):
+    ladder = db.StringProperty()
+    generation = db.IntegerProperty(default=0)
+    status = db.StringProperty()
+    since = db.DateTimeProperty()
+    startDate = db.DateTimeProperty()
+    cursor = db.TextProperty()
+    numGames = db.IntegerProperty()
+    gamesDone = db.IntegerProperty()
+    gamesTotal = db.IntegerProperty()
+    elapsed = db.FloatProperty()
+    started = db.DateTimeProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+    def throughput(self):
+        if not self.elapsed:
+            return 0.0
+        return self.gamesDone / self.elapsed
+
+# stand-in for the task queue in tests, tasks are kept in order until RunTasks. params arrive as strings
+# as they do from the task queue, and a task that raises stays queued for the next RunTasks, as a task
+# the task queue retries
+class LocalTaskQueue(object):
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, url, params=None, queue_name='default'):
+        self.tasks.append((url, dict([(name, str(value)) for name, value in (params or {}).items()])))
+
+    def RunTasks(self):
+        count = 0
+        while self.tasks:
+            url, params = self.tasks[0]
+            TASK_HANDLERS[url](params)
+            self.tasks.pop(0)
+            count += 1
+        return count
+
+task_queue = taskqueue
+
+def AddTask(url, params, queueName='default'):
+    task_queue.add(url=url, params=params, queue_name=queueName)
+
+# start (or restart) the ladder's resimulation from the latest checkpoint before 'since'
+def StartResimulateJob(since=None):
+    # the replay rebuilds the derived records from the games, none may be left to apply on top of it
+    ApplyPendingDerivedRecords()
+    job = ResimulateJob.get_by_key_name(ladder_name)
+    if job is None:
+        job = ResimulateJob(key_name = ladder_name, ladder = ladder_name)
+    elif job.status == 'running':
+        # a restart while running must still cover what the running job had yet to replay
+        if since is not None and job.since is not None:
+            since = min(since, job.since)
+        else:
+            since = None
+
+    checkpoint = GetStartCheckpoint(since)
+    DeleteStaleCheckpoints(checkpoint)
+
+    gameRecord_query = GameRecord.all(keys_only=True).filter("ladder =", ladder_name)
+    if checkpoint:
+        gameRecord_query.filter("date >", checkpoint.date)
+
+    job.generation += 1
+    job.status = 'running'
+    job.since = since
+    job.startDate = checkpoint and checkpoint.date or None
+    job.cursor = None
+    job.numGames = checkpoint and checkpoint.numGames or 0
+    job.gamesDone = 0
+    job.gamesTotal = gameRecord_query.count()
+    job.elapsed = 0.0
+    job.started = datetime.datetime.now()
+    job.put()
+
+    AddTask(RESIMULATE_TASK_URL, {'generation': job.generation})
+    return job
+
+# replay the next chunk of the running job, returns False once there is nothing left to do
+def RunResimulateChunk(generation):
+    job = ResimulateJob.get_by_key_name(ladder_name)
+    if job is None or job.generation != generation or job.status != 'running':
+        return False
+    started = time.time()
 
-    # update rating for each game
+    gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).order('date')
+    if job.startDate:
+        gameRecord_query.filter("date >", job.startDate)
+    if job.cursor:
+        gameRecord_query.with_cursor(job.cursor)
+    games = gameRecord_query.fetch(RESIMULATE_CHUNK_SIZE)
+
+    if job.numGames:
+        checkpoint = RatingCheckpoint.get_by_key_name("%s:%d" % (ladder_name, job.numGames))
+        if checkpoint is None:
+            logging.warning("Checkpoint at game %d is gone, restarting resimulation", job.numGames)
+            StartResimulateJob(job.since)
+            return False
+        replay = checkpoint.get_replay()
+    else:
+        replay = GetStartReplay(None, IterQuery(UserRecord.all().filter("ladder =", ladder_name)))
+
+    job.numGames, checkpoints, changedGames = ReplayGames(replay, games, job.numGames)
+    job.cursor = gameRecord_query.cursor()
+    job.gamesDone += len(games)
+
+    entities = checkpoints + changedGames
+    finished = len(games) < RESIMULATE_CHUNK_SIZE
+    if finished:
+        # the last chunk writes every player's record
+        userRecords = list(IterQuery(UserRecord.all().filter("ladder =", ladder_name)))
+        for userRecord in userRecords:
+            if userRecord.user not in replay.slots:
+                replay.AddPlayer(userRecord.user, ratingChange = userRecord.ratingChange or 0)
+        entities += GetReplayRecords(replay, userRecords, replay.players)
+        job.status = 'done'
+
+    job.elapsed += time.time() - started
+    PutBatched(entities + [job])
+    if finished:
+        # the rank index here and the history task rebuild the derived records of every game
+        MarkPendingDerivedApplied()
+        RebuildRankIndex(replay.rating)
+        InvalidateStandings()
+        AddTask(HISTORY_TASK_URL, {})
+    logging.debug("Resimulated %d of %d games, %.0f games/s", job.gamesDone, job.gamesTotal, job.throughput())
+    return not finished
+
+def RunResimulateTask(params):
+    if RunResimulateChunk(int(params['generation'])):
+        AddTask(RESIMULATE_TASK_URL, params)
+
+# the histories and head to head records are rebuilt once a resimulation has finished
+def RunHistoryTask(params):
+    RebuildRatingHistory(IterQuery(GameRecord.all().filter("ladder =", ladder_name).order('date')))
+    RebuildHeadToHead(IterQuery(GameRecord.all().filter("ladder =", ladder_name)))
+
+# ------------------- Glicko-2 Ratings -------------------------------------------------------------------------------
+# elo is kept game by game. glicko-2 rates in periods, so the whole history is rated in one pass by
+# rating.Glicko2Engine when a period closes (see cron.yaml) and each player's rating is written once.
+# games of the still open period wait for the next run. the ratings live apart from UserRecord so the
+# batch never overwrites a concurrent elo update
+class GlickoRecord(db.Model):
+    ladder = db.StringProperty()
+    user = db.UserProperty()
+    rating = db.FloatProperty()
+    rd = db.FloatProperty()
+    volatility = db.FloatProperty()
+
+def RecalcGlickoRatings():
+    engine = rating.GetEngine(GLICKO_ENGINE)
+    stats = engine.RateHistory(IterQuery(GameRecord.all().filter("ladder =", ladder_name).order('date')), datetime.datetime.now())
+    records = []
+    for player, playerStats in stats.items():
+        records.append(GlickoRecord(key_name = UserRecordKeyName(player), ladder = ladder_name, user = player, **playerStats))
+    PutBatched(records)
+    InvalidateStandings()
+    return len(records)
+
+def RunGlickoTask(params):
+    numRated = RecalcGlickoRatings()
+    logging.info("Rated %d players with glicko-2", numRated)
+
+# ------------------- Match Ingestion --------------------------------------------------------------------------------
+# a report is stored as a pending report, a single write, and applied later by the ingestion task.
+# the ingest queue runs one task at a time (see queue.yaml), so reports are applied by a single
+# worker in the order they were made. pending reports are kept under the ladder's key, an ancestor
+# query sees a report as soon as it is stored
+def GetReportParentKey():
+    return db.Key.from_path('LadderRecord', ladder_name)
+
+class PendingReport(db.Model):
+    ladder = db.StringProperty()
+    date = db.DateTimeProperty()
+    reporter = db.UserProperty()
+    winner = db.UserProperty()
+    loser = db.UserProperty()
+    winner_score = db.IntegerProperty()
+    loser_score = db.IntegerProperty()
+    winner_team = db.StringProperty()
+    loser_team = db.StringProperty()
+    tie = db.BooleanProperty()
+    comment = db.TextProperty()
+
+    # reports stored before they were kept under the ladder keep the names their games were given then
+    def game_key_name(self):
+        if self.key().parent() is None:
+            return "report:%d" % (self.key().id())
+        return "report:%s:%d" % (ladder_name, self.key().id())
+
+    # the game and comment get names from the report, so a report retried after a failure writes them again
+    # rather than twice
+    def create_GameRecord(self):
+        name = self.game_key_name()
+        game = GameRecord(key_name = name, ladder = self.ladder, date = self.date,
+                          winner = self.winner, loser = self.loser, winner_score = self.winner_score, loser_score = self.loser_score,
+                          winner_team = self.winner_team, loser_team = self.loser_team, tie = self.tie,
+                          participants = [self.winner, self.loser])
+        if self.comment:
+            comment = CommentRecord(key_name = name, text = self.comment, user = self.reporter)
+            comment.put()
+            game.comments.append(comment.key())
+        game.num_comments = len(game.comments)
+        return game
+
+# a report that could not be applied, set aside so it no longer holds up the reports after it
+class FailedReport(PendingReport):
+    error = db.TextProperty()
+
+    # the report moves over with its game's name, the comment stored for the game goes with it
+    @staticmethod
+    def fail_PendingReport(report, error):
+        name = report.game_key_name()
+        failed = FailedReport(key_name = name, error = error, **dict([(propertyName, getattr(report, propertyName)) for propertyName in PendingReport.properties()]))
+
+        def txn():
+            if db.get(report.key()) is None:
+                return False
+            db.delete([report.key(), db.Key.from_path('CommentRecord', name)])
+            failed.put()
+            return True
+
+        return db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+
+def QueueReport(report):
+    report.put()
+    AddTask(INGEST_TASK_URL, {}, INGEST_QUEUE)
+
+# apply pending reports oldest first, returns True when there may be more left
+def RunIngestBatch():
+    ApplyPendingDerivedRecords()
+    # reports queued before they were kept under the ladder go first
+    reports = [report for report in PendingReport.all().filter("ladder =", ladder_name).order('date').fetch(INGEST_BATCH_SIZE) if report.key().parent() is None]
+    if len(reports) < INGEST_BATCH_SIZE:
+        reports += PendingReport.all().ancestor(GetReportParentKey()).order('date').fetch(INGEST_BATCH_SIZE - len(reports))
+    for report in reports:
+        try:
+            if not UpdateRatingScore(report.create_GameRecord(), report.key()):
+                logging.info("Report %d was already applied", report.key().id())
+        except (db.Timeout, db.TransactionFailedError, db.InternalError):
+            # the datastore was busy, the task queue retries the batch
+            raise
+        except Exception:
+            logging.exception("Report %d could not be applied, setting it aside", report.key().id())
+            FailedReport.fail_PendingReport(report, traceback.format_exc())
+    if reports:
+        CheckpointIngestedGames()
+    return len(reports) == INGEST_BATCH_SIZE
+
+def RunIngestTask(params):
+    if RunIngestBatch():
+        AddTask(INGEST_TASK_URL, {}, INGEST_QUEUE)
+
+TASK_HANDLERS = {
+    RESIMULATE_TASK_URL: RunResimulateTask,
+    HISTORY_TASK_URL: RunHistoryTask,
+    INGEST_TASK_URL: RunIngestTask,
+    GLICKO_TASK_URL: RunGlickoTask,
+}
+
+# ------------------- Migrations -----------------------------------------------------------------------------------
+# move user records created before they were keyed by ladder and email onto their key. a player
+# with more than one old record keeps the one with the most games
+def MigrateUserRecords():
+    keyedRecords = {}
+    oldRecords = []
+    for userRecord in IterQuery(UserRecord.all()):
+        if userRecord.key().name() == UserRecordKeyName(userRecord.user):
+            keyedRecords[userRecord.key().name()] = userRecord
+        else:
+            oldRecords.append(userRecord)
+
+    newRecords = []
+    for userRecord in oldRecords:
+        keyName = UserRecordKeyName(userRecord.user)
+        current = keyedRecords.get(keyName)
+        if current is not None and NumGames(current) >= NumGames(userRecord):
+            continue
+        values = dict([(name, getattr(userRecord, name)) for name in UserRecord.properties()])
+        values['ladder'] = ladder_name
+        keyedRecords[keyName] = UserRecord(key_name = keyName, **values)
+        newRecords.append(keyedRecords[keyName])
+
+    PutBatched(newRecords)
+    oldKeys = [userRecord.key() for userRecord in oldRecords]
+    for i in xrange(0, len(oldKeys), MAX_BATCH_SIZE):
+        db.delete(oldKeys[i:i + MAX_BATCH_SIZE])
+    ApplyPendingDerivedRecords()
+    RebuildRankIndex([userRecord.rating or 0 for userRecord in keyedRecords.values()])
+    InvalidateStandings()
+    return len(oldRecords)
+
+# fill in the comment count and participants of games stored before they existed
+def MigrateGameRecords():
+    games = [game for game in IterQuery(GameRecord.all().filter("ladder =", ladder_name)) if game.num_comments is None or not game.participants]
     for game in games:
-        UpdateRatingScore( game );
+        game.num_comments = len(game.comments)
+        game.participants = [game.winner, game.loser]
+    PutBatched(games)
+    return len(games)
+
+def NumGames(userRecord):
+    return (userRecord.wins or 0) + (userRecord.draws or 0) + (userRecord.losses or 0)
+
+# ------------------- Provisioning -----------------------------------------------------------------------------------
+# the ladder record and a player's record are created once. memcache remembers that it was done,
+# so steady state page views skip the datastore checks
+def EnsureLadder():
+    cacheKey = "ladder:%s" % (ladder_name)
+    if memcache.get(cacheKey):
+        return
+    LadderRecord.get_or_insert(ladder_name, ladder = ladder_name)
+    memcache.set(cacheKey, True)
+
+# a new player is unrated and stays out of the rank index until their first game
+def CreateUserRecordIfMissing(user):
+    if GetUserRecord(user) is not None:
+        return False
+    UserRecord.create_UserRecord(user).put()
+    return True
+
+def EnsureMembership(user):
+    cacheKey = "member:%s" % (UserRecordKeyName(user))
+    if memcache.get(cacheKey):
+        return
+    EnsureLadder()
+    if db.run_in_transaction(CreateUserRecordIfMissing, user):
+        InvalidateStandings()
+    memcache.set(cacheKey, True)
+
+# ------------------- Standings --------------------------------------------------------------------------------------
+standings_cache = cache.VersionedCache(memcache)
+
+# rating and nickname writes call this so every instance rebuilds the standings
+def InvalidateStandings():
+    standings_cache.BumpVersion(ladder_name)
+
+STANDINGS_DESCRIPTION = {"name": ("string", "Name"),
+                         "rank": ("number", "Rank"),
+                         "wins": ("number", "Wins"),
+                         "losses": ("number", "Losses"),
+                         "draws": ("number", "Draws"),
+                         "gp": ("number", "Total"),
+                         "gf": ("number", "Goals For"),
+                         "ga": ("number", "Goals Against"),
+                         "gd": ("number", "Goal Difference"),
+                         "rating": ("number", "Rating"),
+                         "+-": ("number", "+/-")}
+STANDINGS_COLUMNS = ("rank", "rating", "name", "+-", "wins", "draws", "losses", "gp", "gf", "ga", "gd")
+
+# one row per player in standings order. the rows also carry the nickname and provisional flag
+# the standings api filters on, the table ignores keys that are not in its description
+def BuildStandingsRows():
+    # get all the users
+    userRecords = IterQuery(UserRecord.all().filter("ladder =", ladder_name).order('-rating'))
+
+    # Creating the data
+    data = []
+
+    for index, userRecord in enumerate(userRecords):
+        user = userRecord.user
+        name = user.email() if not userRecord.nickname else "%s (%s)" % (userRecord.nickname, user.email())
+        data.append({"name": (user.email(), name),
+                      "rank": index + 1,
+                      "wins": userRecord.wins,
+                      "losses": userRecord.losses,
+                      "draws": userRecord.draws,
+                      "gp": userRecord.wins + userRecord.losses + userRecord.draws,
+                      "gf": userRecord.goalsfor,
+                      "ga": userRecord.goalsagainst,
+                      "gd": userRecord.goalsfor - userRecord.goalsagainst,
+                      "rating" : userRecord.rating,
+                      "+-": userRecord.ratingChange,
+                      "nickname": userRecord.nickname or "",
+                      "isProvisional": bool(userRecord.isProvisional)
+                      })
+    return data
+
+def GetStandingsRows():
+    return standings_cache.Get(ladder_name, 'standings_rows', BuildStandingsRows)
+
+def BuildStandingsJson():
+    # Loading it into gviz_api.DataTable
+    data_table = gviz_api.DataTable(STANDINGS_DESCRIPTION)
+    data_table.LoadData(GetStandingsRows())
+
+    # Creating a JavaScript code string
+    json = data_table.ToJSon(columns_order=STANDINGS_COLUMNS, order_by="rank")
+    return json
+
+# the rows matching the filters, in standings order
+def FilterStandings(rows, minGames=0, provisionalOnly=False, namePrefix=''):
+    namePrefix = namePrefix.lower()
+    matches = []
+    for row in rows:
+        if row["gp"] < minGames:
+            continue
+        if provisionalOnly and not row["isProvisional"]:
+            continue
+        if namePrefix and not (row["name"][0].lower().startswith(namePrefix) or row["nickname"].lower().startswith(namePrefix)):
+            continue
+        matches.append(row)
+    return matches
+
+# sort on a standings column, ties stay in standings order. the name column sorts on the email
+def SortStandings(rows, column, descending=False):
+    if column not in STANDINGS_DESCRIPTION:
+        raise gviz_api.DataTableException("Unknown sort column '%s'" % column)
+    if column == "name":
+        key = lambda row: row["name"][0]
+    else:
+        key = lambda row: row[column]
+    return sorted(rows, key=key, reverse=descending)
+
+# ------------------- Game Feed --------------------------------------------------------------------------------------
+# feed positions are game dates to the microsecond, "2010-05-01 20:15:00.123456"
+def FeedCursor(date):
+    return "%s.%06d" % (date.strftime(DATE_FORMAT), date.microsecond)
+
+def ParseFeedCursor(cursor):
+    seconds, dot, micro = cursor.partition('.')
+    try:
+        return datetime.datetime.strptime(seconds, DATE_FORMAT).replace(microsecond = int_safe(micro[:6].ljust(6, '0')))
+    except ValueError:
+        return None
+
+# the position of the ladder's latest game, '' before the first game
+def BuildLatestCursor():
+    game = GameRecord.all().filter("ladder =", ladder_name).order('-date').get()
+    if game is None:
+        return ''
+    return FeedCursor(game.date)
+
+def FeedGame(game):
+    values = {'key': str(game.key()),
+              'date': FeedCursor(game.date),
+              'winner': game.winner.email(),
+              'loser': game.loser.email(),
+              'winner_score': game.winner_score,
+              'loser_score': game.loser_score,
+              'tie': game.tie,
+              'winner_rating': None,
+              'winner_change': None,
+              'loser_rating': None,
+              'loser_change': None}
+    if rating.HasLedger(game):
+        values['winner_rating'] = game.winner_rating_after
+        values['winner_change'] = rating.LedgerChange(game.winner_rating_before, game.winner_rating_after)
+        values['loser_rating'] = game.loser_rating_after
+        values['loser_change'] = rating.LedgerChange(game.loser_rating_before, game.loser_rating_after)
+    return values
+
+# the games after 'since', oldest first, with the rating change each one made. without 'since' a new
+# reader starts from the latest FEED_PAGE_SIZE games rather than the start of the ladder's history
+def BuildFeedJson(since):
+    if since is None:
+        games = GameRecord.all().filter("ladder =", ladder_name).order('-date').fetch(FEED_PAGE_SIZE)
+        games.reverse()
+        more = False
+    else:
+        games = GameRecord.all().filter("ladder =", ladder_name).filter("date >", since).order('date').fetch(FEED_PAGE_SIZE + 1)
+        more = len(games) > FEED_PAGE_SIZE
+        games = games[:FEED_PAGE_SIZE]
+    cursor = games and FeedCursor(games[-1].date) or (since and FeedCursor(since) or '')
+    return simplejson.dumps({'since': cursor, 'more': more, 'games': [FeedGame(game) for game in games]})
 
 # ------------------- Request Handlers ----------------------------------------------------------------------------------
 class BasePage(webapp.RequestHandler):
     title = ''
 
-    def write_page_header(self):
-        self.response.headers['Content-Type'] = 'text/html'
-        self.response.out.write('<html><head><title>%s</title>'
+    def page_header(self):
+        return ('<html><head><title>%s</title>'
         '<link href="/stylesheets/main.css" rel="stylesheet" type="text/css"/>'
         '</head><body><div id="main">' % (
-            self.title,))
-        self.write_signin_links()
+            self.title,)) + self.signin_links()
 
-    def write_signin_links(self):
+    def signin_links(self):
         if users.get_current_user():
           template_values = {
               'signed_in': True,
@@ -208,10 +1306,42 @@ class BasePage(webapp.RequestHandler):
               'user_link': users.create_login_url('/')}
         path = os.path.join(os.path.dirname(__file__), 'templates')
         path = os.path.join(path, 'signin.html')
-        self.response.out.write(template.render(path, template_values))
+        return template.render(path, template_values)
+
+    def page_footer(self):
+        return '</div></body></html>'
+
+    def write_page_header(self):
+        self.response.headers['Content-Type'] = 'text/html'
+        self.response.out.write(self.page_header())
+
+    def write_signin_links(self):
+        self.response.out.write(self.signin_links())
 
     def write_page_footer(self):
-        self.response.out.write('</div></body></html>')
+        self.response.out.write(self.page_footer())
+
+    # serve a page that only changes with the ladder version from the page cache. render() returns the
+    # html and its Last-Modified date, and a client holding the current ETag gets a 304 without any
+    # datastore access
+    def write_cached_page(self, name, render):
+        version = standings_cache.GetVersion(ladder_name)
+        etag = '"%s"' % hashlib.md5("%s:%s:%s" % (ladder_name, name, version)).hexdigest()
+        self.response.headers['ETag'] = etag
+        if etag in [tag.strip() for tag in self.request.headers.get('If-None-Match', '').split(',')]:
+            self.response.set_status(304)
+            return
+
+        html, lastModified = standings_cache.Get(ladder_name, 'page:%s' % name, render, version)
+        self.response.headers['Content-Type'] = 'text/html'
+        if lastModified:
+            self.response.headers['Last-Modified'] = lastModified
+        self.response.out.write(html)
+
+    def write_page(self, render):
+        html, lastModified = render()
+        self.response.headers['Content-Type'] = 'text/html'
+        self.response.out.write(html)
 
 class MainPage(BasePage):
     title = 'Game Ladder'
@@ -232,136 +1362,221 @@ class MainPage(BasePage):
 class Ladder(BasePage):
     title = 'Game Ladder'
 
-    def CreateDefaultUser(self):
-        userRecord_query = UserRecord.all().filter("ladder =", ladder_name).filter("user =", users.get_current_user())
-        if userRecord_query.count() > 0:
-            return
-
-        userRecord = UserRecord.create_UserRecord()
-        userRecord.user = users.get_current_user()
-        userRecord.ladder = ladder_name
-        userRecord.put()
+    # the page html and the date of its latest game
+    def render_page(self):
+        # the standings only change when ratings are written, see InvalidateStandings
+        json = standings_cache.Get(ladder_name, 'standings', BuildStandingsJson)
 
-    def CreateLadder(self):
-        userRecords = UserRecord.all().filter("ladder =", ladder_name).fetch(1000)
+        gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).order('-date')
+        games = gameRecord_query.fetch(20)
+        PrefetchComments(games)
 
-        ladderRecord = LadderRecord.all().filter("ladder =", ladder_name).get()
-        if ladderRecord == None:
-            ladderRecord = LadderRecord()
-            ladderRecord.ladder = ladder_name
-            ladderRecord.put()
+        template_values = {
+            'ladder_name' : ladder_name,
+            'user': users.get_current_user(),
+            'games': games,
+            'json': json,
+            'isAdmin': users.is_current_user_admin(),
+        }
 
-        return ladderRecord
+        path = os.path.join(os.path.dirname(__file__), 'templates/ladder.html')
+        html = self.page_header() + template.render(path, template_values) + self.page_footer()
+        return html, games and HttpDate(games[0].date) or None
 
     def get(self):
-        # create current user if he exists
-        if users.get_current_user():
-            self.CreateDefaultUser()
+        # anonymous visitors all see the same page
+        if not users.get_current_user():
+            self.write_cached_page('ladder', self.render_page)
+            return
 
-        # create a ladder if one doesn't exist
-        self.CreateLadder()
+        # create the ladder and the current user's record the first time round
+        EnsureMembership( users.get_current_user() )
 
-        #RecalcRatingScores()
         #RecalcUserStats()
 
-        # get all the users
-        userRecords = UserRecord.all().filter("ladder =", ladder_name).order('-rating').fetch(1000)
+        self.write_page(self.render_page)
 
-        # Creating the data
-        description = {"name": ("string", "Name"),
-                     "rank": ("number", "Rank"),
-                     "wins": ("number", "Wins"),
-                     "losses": ("number", "Losses"),
-                     "draws": ("number", "Draws"),
-                     "gp": ("number", "Total"),
-                     "gf": ("number", "Goals For"),
-                     "ga": ("number", "Goals Against"),
-                     "gd": ("number", "Goal Difference"),
-                     "rating": ("number", "Rating"),
-                     "+-": ("number", "+/-")}
-        data = []
-
-
-        for index, userRecord in enumerate(userRecords):
-            user = userRecord.user
-            name = user.email() if not userRecord.nickname else "%s (%s)" % (userRecord.nickname, user.email())
-            data.append({"name": (user.email(), name),
-                          "rank": index + 1,
-                          "wins": userRecord.wins,
-                          "losses": userRecord.losses,
-                          "draws": userRecord.draws,
-                          "gp": userRecord.wins + userRecord.losses + userRecord.draws,
-                          "gf": userRecord.goalsfor,
-                          "ga": userRecord.goalsagainst,
-                          "gd": userRecord.goalsfor - userRecord.goalsagainst,
-                          "rating" : userRecord.rating,
-                          "+-": userRecord.ratingChange
-                          })
+# the standings as a visualization data source. filtering, sorting and paging happen on the cached rows,
+# so a request costs no datastore reads while the standings are unchanged. strict=1 answers with the bare
+# table as strict json, which api clients can read with a json parser, instead of a visualization response
+class Standings(webapp.RequestHandler):
 
+    def get(self):
+        rows = FilterStandings(GetStandingsRows(),
+                               minGames = int_safe(self.request.get('min_games')),
+                               provisionalOnly = self.request.get('provisional') in ('1', 'true'),
+                               namePrefix = self.request.get('prefix'))
+        total = len(rows)
 
-        # Loading it into gviz_api.DataTable
-        data_table = gviz_api.DataTable(description)
-        data_table.LoadData(data)
+        try:
+            sort = self.request.get('sort')
+            if sort:
+                rows = SortStandings(rows, sort.lstrip('-'), sort.startswith('-') or self.request.get('dir') == 'desc')
+
+            offset = max(int_safe(self.request.get('offset')), 0)
+            limit = int_safe(self.request.get('limit'))
+            if limit <= 0:
+                limit = STANDINGS_PAGE_SIZE
+            rows = rows[offset:offset + min(limit, MAX_STANDINGS_PAGE_SIZE)]
+
+            data_table = gviz_api.DataTable(STANDINGS_DESCRIPTION)
+            data_table.LoadData(rows)
+
+            # written straight into the response, error() clears whatever was written before a failure
+            self.response.headers['X-Standings-Total'] = str(total)
+            if self.request.get('strict') in ('1', 'true'):
+                self.response.headers['Content-Type'] = 'application/json'
+                data_table.WriteJSon(self.response.out, columns_order=STANDINGS_COLUMNS, strict=True)
+            else:
+                self.response.headers['Content-Type'] = 'text/plain'
+                data_table.WriteResponse(self.response.out, columns_order=STANDINGS_COLUMNS, tqx=self.request.get('tqx'))
+        except gviz_api.DataTableException, e:
+            self.error(400)
+            self.response.out.write(str(e))
+
+# games reported since the client's last poll. a client that is up to date is answered from the cached
+# latest game position without a query, other answers are cached per position until the next report
+class Feed(webapp.RequestHandler):
 
-        # Creating a JavaScript code string
-        json = data_table.ToJSon(columns_order=("rank", "rating", "name", "+-", "wins", "draws", "losses", "gp", "gf", "ga", "gd"),
-                                   order_by="rank")
+    def get(self):
+        cursor = self.request.get('since')
+        since = cursor and ParseFeedCursor(cursor) or None
+        if cursor and since is None:
+            self.error(400)
+            self.response.out.write("Bad since '%s'" % cgi.escape(cursor))
+            return
 
+        version = standings_cache.GetVersion(ladder_name)
+        latest = standings_cache.Get(ladder_name, 'feed_latest', BuildLatestCursor, version)
+        self.response.headers['Content-Type'] = 'application/json'
+        if since is not None and FeedCursor(since) >= latest:
+            self.response.out.write(simplejson.dumps({'since': FeedCursor(since), 'more': False, 'games': []}))
+            return
 
-        gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).order('-date')
-        games = gameRecord_query.fetch(20)
+        self.response.out.write(standings_cache.Get(ladder_name, 'feed:%s' % (since and FeedCursor(since) or ''),
+                                                    lambda: BuildFeedJson(since), version))
+
+class Resimulate(BasePage):
+    title = 'Resimulate'
+
+    def get(self):
+        self.render_form()
+
+    def render_form(self, error=None, since=''):
+        job = ResimulateJob.get_by_key_name(ladder_name)
 
         template_values = {
             'ladder_name' : ladder_name,
-            'user': users.get_current_user(),
-            'users': userRecords,
-            'games': games,
-            'json': json,
+            'job': job,
+            'running': job is not None and job.status == 'running',
+            'throughput': job and "%.0f" % job.throughput() or "",
+            'transactions': GetTransactionStats(),
+            'error': error,
+            'since': since,
         }
 
         self.write_page_header()
-
-        path = os.path.join(os.path.dirname(__file__), 'templates/ladder.html')
+        path = os.path.join(os.path.dirname(__file__), 'templates/resimulate.html')
         self.response.out.write(template.render(path, template_values))
-
         self.write_page_footer()
 
-class Resimulate(BasePage):
-    title = 'Resimulate'
+    def post(self):
+        # optional date of the earliest changed game, replay starts from the checkpoint before it
+        since = self.request.get("since").strip()
+        if since:
+            try:
+                sinceDate = datetime.datetime.strptime(since, DATE_FORMAT)
+            except ValueError:
+                self.render_form("Since must be a date like YYYY-MM-DD HH:MM:SS", since)
+                return
+            StartResimulateJob(sinceDate)
+        else:
+            StartResimulateJob()
+        self.redirect('/%s/resimulate' % (ladder_name))
+
+class ResimulateTask(webapp.RequestHandler):
+    def post(self):
+        RunResimulateTask(dict([(name, self.request.get(name)) for name in self.request.arguments()]))
+
+class HistoryTask(webapp.RequestHandler):
+    def post(self):
+        RunHistoryTask(dict([(name, self.request.get(name)) for name in self.request.arguments()]))
+
+# cron requests the task url with a GET, which queues the rating run
+class GlickoTask(webapp.RequestHandler):
+    def get(self):
+        AddTask(GLICKO_TASK_URL, {})
+
+    def post(self):
+        RunGlickoTask(dict([(name, self.request.get(name)) for name in self.request.arguments()]))
+
+class IngestTask(webapp.RequestHandler):
+    def post(self):
+        RunIngestTask(dict([(name, self.request.get(name)) for name in self.request.arguments()]))
+
+class Undo(BasePage):
+    title = 'Undo'
+
+    def post(self):
+        game = UndoLatestGame()
+        if game:
+            logging.debug("Undid game %s - %s reported %s", game.winner, game.loser, game.date)
+        self.redirect('/%s/' % (ladder_name))
+
+class EditGamePage(BasePage):
+    title = 'Edit Game'
+
+    def get(self):
+        game = GameRecord.get( self.request.get('id') )
 
-    def outputPage(self, step):
         template_values = {
-            'step': step
+            'ladder_name' : ladder_name,
+            'game': game,
         }
+
         self.write_page_header()
-        path = os.path.join(os.path.dirname(__file__), 'templates/resimulate.html')
+        path = os.path.join(os.path.dirname(__file__), 'templates/edit.html')
         self.response.out.write(template.render(path, template_values))
         self.write_page_footer()
 
-    def get(self):
-        try:
-            step = self.request.get("step")
-            if( step == None or step == "" ):
-                raise ValueError
-            logging.debug("resimulating step: " + step)
-
-            self.outputPage(step)
-            if( step == "rating" ):
-                RecalcRatingScores()
-                self.redirect('/%s/resimulate?step=' % (ladder_name) + "stats")
-            elif( step == "stats" ):
-                #RecalcUserStats()
-                self.redirect('/%s/' % (ladder_name))
-
-        except ValueError:
-            self.outputPage("rating" + step)
-            self.redirect('/%s/resimulate?step=' % (ladder_name) + "rating")
-            return
+    def post(self):
+        game = GameRecord.get( self.request.get('id') )
+        winner_score = int_safe( self.request.get('winner_score') )
+        loser_score = int_safe( self.request.get('loser_score') )
+
+        values = {
+            'winner_score': max(winner_score, loser_score),
+            'loser_score': min(winner_score, loser_score),
+            'tie': self.request.get('tie') == 'tie',
+            'winner_team': self.request.get('winner_team'),
+            'loser_team': self.request.get('loser_team'),
+        }
+        if self.request.get('swap') == 'swap':
+            values['winner'] = game.loser
+            values['loser'] = game.winner
+            values['participants'] = [game.loser, game.winner]
+            values['winner_team'], values['loser_team'] = values['loser_team'], values['winner_team']
+
+        EditGame(game, values)
+
+        self.redirect('/%s/' % (ladder_name))
+
+class Migrate(BasePage):
+    title = 'Migrate'
+
+    def post(self):
+        numMigrated = MigrateUserRecords()
+        logging.info("Re-keyed %d user records", numMigrated)
+        numMigrated = MigrateGameRecords()
+        logging.info("Updated %d game records", numMigrated)
+        RebuildHeadToHead(IterQuery(GameRecord.all().filter("ladder =", ladder_name)))
+        self.redirect('/%s/account' % (ladder_name))
 
 class Account(BasePage):
     title = 'My Account'
 
     def get(self):
+        EnsureMembership( users.get_current_user() )
         user = GetUserRecord( users.get_current_user() )
         if not user.nickname:
             user.nickname = user.user.nickname()
@@ -379,11 +1594,13 @@ class Account(BasePage):
         self.write_page_footer()
 
     def post(self):
+        EnsureMembership( users.get_current_user() )
         user = GetUserRecord( users.get_current_user() )
         nickname = self.request.get('nickname')
         if nickname:
             user.nickname = nickname
             user.put()
+            InvalidateStandings()
 
         logging.debug("Nickname: %s", nickname)
 
@@ -394,17 +1611,35 @@ class Account(BasePage):
 class User(BasePage):
     title = 'User'
 
-    def get(self):
-
-        user = users.User( self.request.get('id') )
+    # the player's rating after each game, from the one history entity
+    def history_table(self, user):
+        history = RatingHistory.get_by_key_name(UserRecordKeyName(user))
+        description = [("date", "datetime", "Date"), ("rating", "number", "Rating"), ("opponent", "string", "Opponent"), ("delta", "number", "+/-")]
+        data_history = gviz_api.DataTable(description)
+        if history:
+            data_history.LoadData([[date, playerRating, opponent.nickname(), delta] for date, playerRating, opponent, delta in zip(history.dates, history.ratings, history.opponents, history.deltas)])
+        return data_history
+
+    # one page of the player's games, newest first, starting at 'cursor'
+    def render_page(self, user, cursor):
         userRecord = GetUserRecord( user )
 
-        gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).filter('winner = ', user)
-        games = gameRecord_query.fetch(1000)
-        gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).filter('loser = ', user)
-        games += gameRecord_query.fetch(1000)
-        games.sort(lambda x,y: -cmp(x.date,y.date))
-
+        gameRecord_query = GameRecord.all().filter("ladder =", ladder_name).filter('participants =', user).order('-date')
+        if cursor:
+            gameRecord_query.with_cursor(cursor)
+        games = gameRecord_query.fetch(USER_GAMES_PAGE_SIZE)
+        nextCursor = None
+        if len(games) == USER_GAMES_PAGE_SIZE:
+            nextCursor = gameRecord_query.cursor()
+        PrefetchComments(games)
+
+        # the player's place in the standings and the players around it, an unrated player has no place
+        # and is shown the bottom of the standings
+        index = GetRankIndex()
+        rank = None
+        if userRecord.rating:
+            rank = index.Rank(userRecord.rating)
+        nearby = GetPlayersByRank(max((rank or index.Total() + 1) - RANK_NEIGHBOURS, 1), 2 * RANK_NEIGHBOURS + 1, index)
 
         # Creating the data
         description = {"type": "string", "number": "number"}
@@ -416,35 +1651,96 @@ class User(BasePage):
 
         # Creating a JavaScript code string
         json = data_piechart.ToJSon(columns_order=("type", "number"))
+        history_json = self.history_table(user).ToJSon(columns_order=("date", "rating"))
 
         template_values = {
             'ladder_name' : ladder_name,
             'userRecord': userRecord,
             'games': games,
             'json': json,
+            'history_json': history_json,
+            'rank': rank,
+            'num_players': index.Total(),
+            'nearby': nearby,
+            'glicko': GlickoRecord.get_by_key_name(UserRecordKeyName(user)),
+            'next_cursor': nextCursor,
         }
 
-        self.write_page_header()
         path = os.path.join(os.path.dirname(__file__), 'templates/user.html')
-        self.response.out.write(template.render(path, template_values))
+        html = self.page_header() + template.render(path, template_values) + self.page_footer()
+        return html, games and HttpDate(games[0].date) or None
 
-        #self.response.out.write("userid: " + self.request.get('id') )
+    def get(self):
 
-        self.write_page_footer()
+        user = users.User( self.request.get('id') )
+
+        # the rating history as a visualization data source
+        if self.request.get('tqx') or self.request.get('out') == 'history':
+            try:
+                self.response.headers['Content-Type'] = 'text/plain'
+                self.history_table(user).WriteResponse(self.response.out, tqx=self.request.get('tqx'))
+            except gviz_api.DataTableException, e:
+                self.error(400)
+                self.response.out.write(str(e))
+            return
+
+        cursor = self.request.get('cursor')
+        render = lambda: self.render_page(user, cursor)
+
+        # only the first page is cached for anonymous visitors
+        if not users.get_current_user() and not cursor:
+            self.write_cached_page('user:%s' % (user.email()), render)
+        else:
+            self.write_page(render)
+
+class HeadToHeadPage(BasePage):
+    title = 'Head to Head'
+
+    # the two players and their record, three keys in one fetch
+    def render_page(self, playerA, playerB):
+        userRecordA, userRecordB, headToHead = db.get([GetUserRecordKey(playerA), GetUserRecordKey(playerB),
+                                                       db.Key.from_path('HeadToHead', HeadToHeadKeyName(playerA, playerB))])
+        if headToHead is None:
+            headToHead = HeadToHead.create_HeadToHead(playerA, playerB)
+
+        template_values = {
+            'ladder_name' : ladder_name,
+            'playerA': userRecordA or UserRecord.create_UserRecord(playerA),
+            'playerB': userRecordB or UserRecord.create_UserRecord(playerB),
+            'stats': headToHead.stats_for(playerA),
+        }
+
+        path = os.path.join(os.path.dirname(__file__), 'templates/head2head.html')
+        html = self.page_header() + template.render(path, template_values) + self.page_footer()
+        return html, None
+
+    def get(self):
+        playerA = users.User( self.request.get('a') )
+        playerB = users.User( self.request.get('b') )
+        render = lambda: self.render_page(playerA, playerB)
+
+        if not users.get_current_user():
+            self.write_cached_page('head2head:%s:%s' % (playerA.email(), playerB.email()), render)
+        else:
+            self.write_page(render)
 
 class Report(BasePage):
     title = 'Report'
 
     def get(self):
+        self.render_form()
+
+    def render_form(self, error=None):
         # get all the users
-        userRecords = UserRecord.all().order('user').fetch(1000)
+        userRecords = IterQuery(UserRecord.all().order('user'))
         # remove current user from opponent list
         opponents = [user for user in userRecords if user.user != users.get_current_user() ];
 
         template_values = {
             'ladder_name' : ladder_name,
             'user': users.get_current_user(),
-            'opponents': opponents
+            'opponents': opponents,
+            'error': error,
         }
 
         self.write_page_header()
@@ -456,42 +1752,47 @@ class Report(BasePage):
         player_score = int_safe( self.request.get('player_score') )
         opponent_score = int_safe( self.request.get('opponent_score') )
 
-        game = GameRecord()
-        game.ladder = ladder_name
-        game.winner_score = max(player_score, opponent_score)
-        game.loser_score = min(player_score, opponent_score)
+        # a report the ingestion task could not apply is turned away here, both players need a record
+        # and the texts must fit the game's properties
+        EnsureMembership( users.get_current_user() )
+        opponentEmail = self.request.get('opponent')
+        if not opponentEmail or GetUserRecord( users.User( opponentEmail ) ) is None:
+            self.render_form("Unknown opponent")
+            return
+        for name in ('player_team', 'opponent_team', 'comment'):
+            if len(self.request.get(name)) > MAX_REPORT_TEXT_LENGTH:
+                self.render_form("Team names and comments can be at most %d characters" % MAX_REPORT_TEXT_LENGTH)
+                return
+
+        report = PendingReport(parent = GetReportParentKey())
+        report.ladder = ladder_name
+        report.date = datetime.datetime.now()
+        report.reporter = users.get_current_user()
+        report.winner_score = max(player_score, opponent_score)
+        report.loser_score = min(player_score, opponent_score)
         if self.request.get('win') == 'win':
-            game.winner = users.get_current_user()
-            game.loser = users.User( self.request.get('opponent') )
-            game.winner_team = self.request.get('player_team')
-            game.loser_team = self.request.get('opponent_team')
+            report.winner = users.get_current_user()
+            report.loser = users.User( self.request.get('opponent') )
+            report.winner_team = self.request.get('player_team')
+            report.loser_team = self.request.get('opponent_team')
         else:
-            game.winner = users.User( self.request.get('opponent') )
-            game.loser = users.get_current_user()
-            game.winner_team = self.request.get('opponent_team')
-            game.loser_team = self.request.get('player_teamn')
-        game.tie = self.request.get('win') == 'draw'
+            report.winner = users.User( self.request.get('opponent') )
+            report.loser = users.get_current_user()
+            report.winner_team = self.request.get('opponent_team')
+            report.loser_team = self.request.get('player_teamn')
+        report.tie = self.request.get('win') == 'draw'
 
         #self.response.out.write( "winner_score: " + str(game.winner) )
 
         # hmm, bad data...
-        if game.winner == game.loser:
-            self.redirect('/%s/' % (ladder_name))
-
-        commentText = self.request.get('comment');
-        if commentText:
-            comment = CommentRecord()
-            comment.text = commentText
-            comment.user = users.get_current_user()
-            comment.put()
-
-            game.comments.append( comment.key() )
-
+        if report.winner == report.loser:
+            self.render_form("You cannot report a game against yourself")
+            return
 
-        game.put()
+        report.comment = self.request.get('comment') or None
 
-        # Update elo ratings
-        UpdateRatingScore( game );
+        # the game and the elo update are applied by the ingestion task
+        QueueReport( report );
 
         self.redirect('/%s/' % (ladder_name))
 
@@ -502,9 +1803,19 @@ application = webapp.WSGIApplication(
                                       ('/%s' % (ladder_name), Ladder),
                                       ('/%s/' % (ladder_name), Ladder),
                                       ('/%s/resimulate' % (ladder_name), Resimulate),
+                                      (RESIMULATE_TASK_URL, ResimulateTask),
+                                      (HISTORY_TASK_URL, HistoryTask),
+                                      (INGEST_TASK_URL, IngestTask),
+                                      (GLICKO_TASK_URL, GlickoTask),
+                                      ('/%s/undo' % (ladder_name), Undo),
+                                      ('/%s/edit' % (ladder_name), EditGamePage),
+                                      ('/%s/migrate' % (ladder_name), Migrate),
                                       ('/%s/report' % (ladder_name), Report),
                                       ('/%s/account' % (ladder_name), Account),
-                                      ('/%s/user' % (ladder_name), User)],
+                                      ('/%s/user' % (ladder_name), User),
+                                      ('/%s/head2head' % (ladder_name), HeadToHeadPage),
+                                      ('/%s/standings' % (ladder_name), Standings),
+                                      ('/%s/feed' % (ladder_name), Feed)],
                                      debug=True)
 
 def real_main():
@@ -26,16 +26,394 @@ Google Visualization API.
 
 __author__ = "Amit Weinstein, Misha Seltzer"
 
+import array
 import cgi
 import datetime
+import re
 import types
 
+try:
+  import json
+except ImportError:
+  # Python 2.5 has no json module, App Engine ships simplejson with django.
+  from django.utils import simplejson as json
+
 
 class DataTableException(Exception):
   """The general exception object thrown by DataTable."""
   pass
 
 
+class _ListColumn(object):
+  """A column stored as a list of its cell values. Internal helper class."""
+
+  def __init__(self, values=None):
+    self.values = values or []
+    self.Get = self.values.__getitem__
+
+  def Append(self, value):
+    self.values.append(value)
+    return True
+
+  def ToList(self):
+    return list(self.values)
+
+
+class _TypedColumn(object):
+  """A number or boolean column stored in a typed array. Internal helper class.
+
+  The array type is picked by the first value, "l" for int, "d" for float and
+  "b" for bool. Empty cells are kept in a null bitmap and formatted values in a
+  dictionary by row, so every cell reads back exactly as it was given. Append()
+  refuses any value that would not (another type, a long that overflows), and
+  the store then moves the column to a list.
+  """
+
+  TYPECODES = {int: "l", float: "d", bool: "b"}
+
+  def __init__(self, allowed_types):
+    self.allowed_types = allowed_types
+    self.value_type = None
+    self.values = None
+    self.nulls = array.array("B")
+    self.formatted = {}
+    self.size = 0
+
+  def Append(self, value):
+    stored = value
+    formatted = None
+    if isinstance(value, tuple) and len(value) == 2 and value[0] is not None:
+      stored, formatted = value
+
+    if stored is not None:
+      if self.values is None:
+        if type(stored) not in self.allowed_types:
+          return False
+        self.value_type = type(stored)
+        self.values = array.array(self.TYPECODES[self.value_type],
+                                  [0] * self.size)
+      elif type(stored) is not self.value_type:
+        return False
+      try:
+        self.values.append(stored)
+      except OverflowError:
+        return False
+      if formatted is not None:
+        self.formatted[self.size] = formatted
+
+    if not self.size % 8:
+      self.nulls.append(0)
+    if stored is None:
+      self.nulls[self.size >> 3] |= 1 << (self.size & 7)
+      if self.values is not None:
+        self.values.append(0)
+    self.size += 1
+    return True
+
+  def Get(self, index):
+    if self.nulls[index >> 3] & (1 << (index & 7)):
+      return None
+    value = self.values[index]
+    if self.value_type is bool:
+      value = bool(value)
+    if index in self.formatted:
+      return (value, self.formatted[index])
+    return value
+
+  def ToList(self):
+    return [self.Get(index) for index in xrange(self.size)]
+
+
+class _ColumnStore(object):
+  """Column by column storage of a DataTable's rows. Internal helper class."""
+
+  def __init__(self, columns):
+    self.columns = {}
+    for col in columns:
+      if col["type"] == "number":
+        self.columns[col["id"]] = _TypedColumn((int, float))
+      elif col["type"] == "boolean":
+        self.columns[col["id"]] = _TypedColumn((bool,))
+      else:
+        self.columns[col["id"]] = _ListColumn()
+    self.num_rows = 0
+
+  def AppendRow(self, row):
+    for col_id, column in self.columns.items():
+      value = row.get(col_id)
+      if not column.Append(value):
+        column = _ListColumn(column.ToList())
+        column.Append(value)
+        self.columns[col_id] = column
+    self.num_rows += 1
+
+  def Getter(self, col_id):
+    if col_id not in self.columns:
+      # Sorting on a column the table does not have leaves the order as is.
+      return lambda index: None
+    return self.columns[col_id].Get
+
+  def Row(self, index):
+    row = {}
+    for col_id, column in self.columns.items():
+      value = column.Get(index)
+      if value is not None:
+        row[col_id] = value
+    return row
+
+
+# The characters repr() escapes in a unicode string: the backslash, the single
+# quote and the characters that are not printable ASCII, up to 0xff.
+_UNICODE_ESCAPES = re.compile(u"[\\x00-\\x1f\\\\'\\x7f-\\xff]")
+
+
+def _SortValue(value):
+  """Returns the sort key of a cell value. Internal helper function.
+
+  Pairing each value with whether it is set sorts None first, as comparing it
+  does, without ever comparing it to a value of another type (e.g. a date,
+  which raises).
+  """
+  return (value is not None, value)
+
+
+class _MixedSortKey(object):
+  """Sort key of a row ordered by keys of mixed directions. Internal helper.
+
+  Compares the values key by key, each in its own direction, and stops at the
+  first key that differs, as the cmp function the rows were once sorted with
+  did. A less significant value is never compared where a more significant one
+  decides the order, e.g. a formatted (value, format) cell with a plain one.
+  """
+  __slots__ = ("values", "directions")
+
+  def __init__(self, values, directions):
+    self.values = values
+    self.directions = directions
+
+  def __lt__(self, other):
+    other_values = other.values
+    for i, asc_mult in enumerate(self.directions):
+      result = cmp(self.values[i], other_values[i])
+      if result:
+        return asc_mult * result < 0
+    return False
+
+
+# The value encoders, one for each column type. Each translates a single value
+# of its type into a JS value, with the checks and results of
+# DataTable.SingleValueToJS(). The value the type expects is checked first, so
+# most cells cost a single call and type check.
+
+
+def _FormattedToJS(encoder, value):
+  """Translates a (value, formatted value) tuple. Internal helper function."""
+  if len(value) != 2:
+    raise DataTableException("Wrong format for value and formatting - %s." %
+                             str(value))
+  if not isinstance(value[1], types.StringTypes):
+    raise DataTableException("Formatted value is not string, given %s." %
+                             type(value[1]))
+  js_value = encoder(value[0])
+  if js_value == "null":
+    raise DataTableException("An empty cell can not have formatting.")
+  return (js_value, DataTable._EscapeValue(value[1]))
+
+
+def _BooleanToJS(value):
+  if value is True:
+    return "true"
+  if value is False:
+    return "false"
+  if value is None:
+    return "null"
+  if isinstance(value, tuple):
+    return _FormattedToJS(_BooleanToJS, value)
+  if value:
+    return "true"
+  return "false"
+
+
+def _NumberToJS(value):
+  if isinstance(value, (int, long, float)):
+    return str(value)
+  if value is None:
+    return "null"
+  if isinstance(value, tuple):
+    return _FormattedToJS(_NumberToJS, value)
+  raise DataTableException("Wrong type %s when expected number" % type(value))
+
+
+def _StringToJS(value):
+  if value is None:
+    return "null"
+  if isinstance(value, tuple):
+    return _FormattedToJS(_StringToJS, value)
+  return DataTable._EscapeValue(value)
+
+
+def _DateToJS(value):
+  if isinstance(value, datetime.date):
+    # We need to shift the month by 1 to match JS Date format
+    return "new Date(%d,%d,%d)" % (value.year, value.month - 1, value.day)
+  if value is None:
+    return "null"
+  if isinstance(value, tuple):
+    return _FormattedToJS(_DateToJS, value)
+  raise DataTableException("Wrong type %s when expected date" % type(value))
+
+
+def _TimeOfDayToJS(value):
+  if isinstance(value, (datetime.time, datetime.datetime)):
+    return "[%d,%d,%d]" % (value.hour, value.minute, value.second)
+  if value is None:
+    return "null"
+  if isinstance(value, tuple):
+    return _FormattedToJS(_TimeOfDayToJS, value)
+  raise DataTableException("Wrong type %s when expected time" % type(value))
+
+
+def _DateTimeToJS(value):
+  if isinstance(value, datetime.datetime):
+    return "new Date(%d,%d,%d,%d,%d,%d)" % (value.year,
+                                            value.month - 1,  # To match JS
+                                            value.day,
+                                            value.hour,
+                                            value.minute,
+                                            value.second)
+  if value is None:
+    return "null"
+  if isinstance(value, tuple):
+    return _FormattedToJS(_DateTimeToJS, value)
+  raise DataTableException("Wrong type %s when expected datetime" %
+                           type(value))
+
+
+def _UnsupportedToJS(value_type):
+  """Returns the encoder of a type that is not supported."""
+  def Encoder(value):
+    if value is None:
+      return "null"
+    if isinstance(value, tuple):
+      return _FormattedToJS(Encoder, value)
+    # If we got here, it means the given value_type was not one of the
+    # supported types.
+    raise DataTableException("Unsupported type %s" % value_type)
+  return Encoder
+
+
+_VALUE_ENCODERS = {"boolean": _BooleanToJS,
+                   "number": _NumberToJS,
+                   "string": _StringToJS,
+                   "date": _DateToJS,
+                   "timeofday": _TimeOfDayToJS,
+                   "datetime": _DateTimeToJS}
+
+
+# The strict JSON value encoders. Each translates a single value of its type
+# into the value the JSON encoder writes for it in the gviz wire format, with
+# the checks of the JS value encoders above: dates and datetimes become
+# "Date(...)" strings and times of day [hour, minute, second] lists. A
+# formatted value gives a (value, formatted value) tuple.
+
+
+def _FormattedToJSon(encoder, value):
+  """Translates a (value, formatted value) tuple. Internal helper function."""
+  if len(value) != 2:
+    raise DataTableException("Wrong format for value and formatting - %s." %
+                             str(value))
+  if not isinstance(value[1], types.StringTypes):
+    raise DataTableException("Formatted value is not string, given %s." %
+                             type(value[1]))
+  json_value = encoder(value[0])
+  if json_value is None:
+    raise DataTableException("An empty cell can not have formatting.")
+  return (json_value, value[1])
+
+
+def _BooleanToJSon(value):
+  if value is True or value is False:
+    return value
+  if value is None:
+    return None
+  if isinstance(value, tuple):
+    return _FormattedToJSon(_BooleanToJSon, value)
+  return bool(value)
+
+
+def _NumberToJSon(value):
+  if isinstance(value, (int, long, float)):
+    return value
+  if value is None:
+    return None
+  if isinstance(value, tuple):
+    return _FormattedToJSon(_NumberToJSon, value)
+  raise DataTableException("Wrong type %s when expected number" % type(value))
+
+
+def _StringToJSon(value):
+  if isinstance(value, types.StringTypes):
+    return value
+  if value is None:
+    return None
+  if isinstance(value, tuple):
+    return _FormattedToJSon(_StringToJSon, value)
+  return str(value)
+
+
+def _DateToJSon(value):
+  if isinstance(value, datetime.date):
+    return "Date(%d,%d,%d)" % (value.year, value.month - 1, value.day)
+  if value is None:
+    return None
+  if isinstance(value, tuple):
+    return _FormattedToJSon(_DateToJSon, value)
+  raise DataTableException("Wrong type %s when expected date" % type(value))
+
+
+def _TimeOfDayToJSon(value):
+  if isinstance(value, (datetime.time, datetime.datetime)):
+    return [value.hour, value.minute, value.second]
+  if value is None:
+    return None
+  if isinstance(value, tuple):
+    return _FormattedToJSon(_TimeOfDayToJSon, value)
+  raise DataTableException("Wrong type %s when expected time" % type(value))
+
+
+def _DateTimeToJSon(value):
+  if isinstance(value, datetime.datetime):
+    return "Date(%d,%d,%d,%d,%d,%d)" % (value.year, value.month - 1, value.day,
+                                        value.hour, value.minute, value.second)
+  if value is None:
+    return None
+  if isinstance(value, tuple):
+    return _FormattedToJSon(_DateTimeToJSon, value)
+  raise DataTableException("Wrong type %s when expected datetime" %
+                           type(value))
+
+
+def _UnsupportedToJSon(value_type):
+  """Returns the strict JSON encoder of a type that is not supported."""
+  def Encoder(value):
+    if value is None:
+      return None
+    if isinstance(value, tuple):
+      return _FormattedToJSon(Encoder, value)
+    raise DataTableException("Unsupported type %s" % value_type)
+  return Encoder
+
+
+_JSON_VALUE_ENCODERS = {"boolean": _BooleanToJSon,
+                        "number": _NumberToJSon,
+                        "string": _StringToJSon,
+                        "date": _DateToJSon,
+                        "timeofday": _TimeOfDayToJSon,
+                        "datetime": _DateTimeToJSon}
+
+_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+
 class DataTable(object):
 
   """Wraps the data to convert to a Google Visualization API DataTable.
@@ -107,7 +485,7 @@ class DataTable(object):
     3  4  w
   """
 
-  def __init__(self, table_description, data=None):
+  def __init__(self, table_description, data=None, columnar=False):
     """Initialize the data table from a table schema and (optionally) data.
 
     See the class documentation for more information on table schema and data
@@ -122,13 +500,26 @@ class DataTable(object):
             structure must be consistent with schema in table_description. See
             the class documentation for more information on acceptable data. You
             can add data later by calling AppendData().
+      columnar: Optional. If True, the rows are stored column by column rather
+                than as a dictionary per row: number and boolean columns in
+                typed arrays with a null bitmap, other columns in lists. This
+                takes far less memory for large tables, and every output is the
+                same as with the default storage.
 
     Raises:
       DataTableException: Raised if the data and the description did not match,
                           or did not use the supported formats.
     """
     self.__columns = self.TableDescriptionParser(table_description)
+    self.__encoders = dict([(col["id"], self._ValueEncoder(col["type"]))
+                            for col in self.__columns])
+    self.__json_encoders = dict([(col["id"],
+                                  self._ValueEncoder(col["type"], strict=True))
+                                 for col in self.__columns])
     self.__data = []
+    self.__store = None
+    if columnar:
+      self.__store = _ColumnStore(self.__columns)
     if data:
       self.LoadData(data)
 
@@ -136,6 +527,9 @@ class DataTable(object):
   def _EscapeValue(v):
     """Puts the string in quotes, and escapes any inner quotes and slashes."""
     if isinstance(v, unicode):
+      # Most strings have nothing to escape, and only need the quotes.
+      if _UNICODE_ESCAPES.search(v) is None:
+        return u"'%s'" % v
       # Here we use repr as in the usual case, but on unicode strings, it
       # also escapes the unicode characters (which we want to leave as is).
       # So, after repr() we decode using raw-unicode-escape, which decodes
@@ -175,63 +569,34 @@ class DataTable(object):
       DataTableException: The value and type did not match in a not-recoverable
                           way, for example given value 'abc' for type 'number'.
     """
-    if isinstance(value, tuple):
-      # In case of a tuple, we run the same function on the value itself and
-      # add the formatted value.
-      if len(value) != 2:
-        raise DataTableException("Wrong format for value and formatting - %s." %
-                                 str(value))
-      if not isinstance(value[1], types.StringTypes):
-        raise DataTableException("Formatted value is not string, given %s." %
-                                 type(value[1]))
-      js_value = DataTable.SingleValueToJS(value[0], value_type)
-      if js_value == "null":
-        raise DataTableException("An empty cell can not have formatting.")
-      return (js_value, DataTable._EscapeValue(value[1]))
-
-    # The standard case - no formatting.
-    t_value = type(value)
-    if value is None:
-      return "null"
-    if value_type == "boolean":
-      if value:
-        return "true"
-      return "false"
-
-    elif value_type == "number":
-      if isinstance(value, (int, long, float)):
-        return str(value)
-      raise DataTableException("Wrong type %s when expected number" % t_value)
-
-    elif value_type == "string":
-      if isinstance(value, tuple):
-        raise DataTableException("Tuple is not allowed as string value.")
-      return DataTable._EscapeValue(value)
-
-    elif value_type == "date":
-      if not isinstance(value, (datetime.date, datetime.datetime)):
-        raise DataTableException("Wrong type %s when expected date" % t_value)
-        # We need to shift the month by 1 to match JS Date format
-      return "new Date(%d,%d,%d)" % (value.year, value.month - 1, value.day)
-
-    elif value_type == "timeofday":
-      if not isinstance(value, (datetime.time, datetime.datetime)):
-        raise DataTableException("Wrong type %s when expected time" % t_value)
-      return "[%d,%d,%d]" % (value.hour, value.minute, value.second)
-
-    elif value_type == "datetime":
-      if not isinstance(value, datetime.datetime):
-        raise DataTableException("Wrong type %s when expected datetime" %
-                                 t_value)
-      return "new Date(%d,%d,%d,%d,%d,%d)" % (value.year,
-                                              value.month - 1,  # To match JS
-                                              value.day,
-                                              value.hour,
-                                              value.minute,
-                                              value.second)
-    # If we got here, it means the given value_type was not one of the
-    # supported types.
-    raise DataTableException("Unsupported type %s" % value_type)
+    return DataTable._ValueEncoder(value_type)(value)
+
+  @staticmethod
+  def _ValueEncoder(value_type, strict=False):
+    """Returns the encoder translating single values of value_type into JS.
+
+    Internal helper method.
+
+    Args:
+      value_type: One of the types supported by SingleValueToJS().
+      strict: Optional. If True, the encoder translates values for the strict
+              JSON output instead, see ToJSon().
+
+    Returns:
+      A function of a single value, returning what SingleValueToJS() would
+      return for the value and value_type. The strict JSON encoder returns
+      the value to pass to the JSON encoder instead of the JS string, and None
+      for None.
+    """
+    if strict:
+      encoder = _JSON_VALUE_ENCODERS.get(value_type)
+      if encoder is None:
+        encoder = _UnsupportedToJSon(value_type)
+      return encoder
+    encoder = _VALUE_ENCODERS.get(value_type)
+    if encoder is None:
+      encoder = _UnsupportedToJS(value_type)
+    return encoder
 
   @staticmethod
   def ColumnTypeParser(description):
@@ -408,11 +773,15 @@ class DataTable(object):
 
   def NumberOfRows(self):
     """Returns the number of rows in the current data stored in the table."""
+    if self.__store is not None:
+      return self.__store.num_rows
     return len(self.__data)
 
   def LoadData(self, data):
     """Loads new data to the data table, clearing existing data."""
     self.__data = []
+    if self.__store is not None:
+      self.__store = _ColumnStore(self.__columns)
     self.AppendData(data)
 
   def AppendData(self, data):
@@ -448,7 +817,7 @@ class DataTable(object):
     # Dealing with the scalar case, the data is the last value.
     if self.__columns[col_index]["container"] == "scalar":
       prev_col_values[self.__columns[col_index]["id"]] = data
-      self.__data.append(prev_col_values)
+      self._AppendRow(prev_col_values)
       return
 
     if self.__columns[col_index]["container"] == "iter":
@@ -462,7 +831,7 @@ class DataTable(object):
           raise DataTableException("Too many elements given in data")
         prev_col_values[self.__columns[col_index]["id"]] = value
         col_index += 1
-      self.__data.append(prev_col_values)
+      self._AppendRow(prev_col_values)
       return
 
     # We know the current level is a dictionary, we verify the type.
@@ -475,41 +844,41 @@ class DataTable(object):
       for col in self.__columns[col_index:]:
         if col["id"] in data:
           prev_col_values[col["id"]] = data[col["id"]]
-      self.__data.append(prev_col_values)
+      self._AppendRow(prev_col_values)
       return
 
     # We have a dictionary in an inner depth level.
     if not data.keys():
       # In case this is an empty dictionary, we add a record with the columns
       # filled only until this point.
-      self.__data.append(prev_col_values)
+      self._AppendRow(prev_col_values)
     else:
       for key in sorted(data):
         col_values = dict(prev_col_values)
         col_values[self.__columns[col_index]["id"]] = key
         self._InnerAppendData(col_values, data[key], col_index + 1)
 
-  def _PreparedData(self, order_by=()):
-    """Prepares the data for enumeration - sorting it by order_by.
+  def _AppendRow(self, row):
+    """Stores one row, given as a dictionary of column id to value."""
+    if self.__store is not None:
+      self.__store.AppendRow(row)
+    else:
+      self.__data.append(row)
+
+  @staticmethod
+  def _SortKeys(order_by):
+    """Parses order_by into the keys that order the rows.
 
     Args:
-      order_by: Optional. Specifies the name of the column(s) to sort by, and
-                (optionally) which direction to sort in. Default sort direction
-                is asc. Following formats are accepted:
-                "string_col_name"  -- For a single key in default (asc) order.
-                ("string_col_name", "asc|desc") -- For a single key.
-                [("col_1","asc|desc"), ("col_2","asc|desc")] -- For more than
-                    one column, an array of tuples of (col_name, "asc|desc").
+      order_by: The order_by argument of _PreparedData().
 
     Returns:
-      The data sorted by the keys given.
+      A list of (column id, 1 for asc or -1 for desc) tuples, most significant
+      first.
 
     Raises:
       DataTableException: Sort direction not in 'asc' or 'desc'
     """
-    if not order_by:
-      return self.__data
-
     proper_sort_keys = []
     if isinstance(order_by, types.StringTypes) or (
         isinstance(order_by, tuple) and len(order_by) == 2 and
@@ -524,16 +893,128 @@ class DataTable(object):
       else:
         raise DataTableException("Expected tuple with second value: "
                                  "'asc' or 'desc'")
+    return proper_sort_keys
+
+  @staticmethod
+  def _Sorted(items, getters, directions):
+    """Sorts items in one pass by the values the getters return for them.
+
+    Keys in a single direction sort on a tuple of their values, reversed for
+    desc. Python's sort is stable also with reverse=True, and tuples compare
+    element by element up to the first difference, so this orders as
+    comparing the keys one after the other does. Mixed directions sort a pass
+    per run of keys. Those passes also compare less significant values where
+    a more significant key already decides, so when that raises the items
+    are sorted again on a _MixedSortKey, which compares up to the first
+    difference with a direction per key.
+
+    Args:
+      items: The rows, or row indexes for columnar storage.
+      getters: One function per key, returning the key's value for an item.
+      directions: 1 (asc) or -1 (desc) for each getter.
 
-    def SortCmpFunc(row1, row2):
-      """cmp function for sorted. Compares by keys and 'asc'/'desc' keywords."""
-      for key, asc_mult in proper_sort_keys:
-        cmp_result = asc_mult * cmp(row1.get(key), row2.get(key))
-        if cmp_result:
-          return cmp_result
-      return 0
+    Returns:
+      The items as a new sorted list.
+    """
+    if len(set(directions)) == 1:
+      return DataTable._SortedRun(items, getters, directions[0])
+    try:
+      # A pass per run of keys with the same direction, least significant run
+      # first. The sort is stable, so where every pair of values compares this
+      # gives the same order, and it is faster than comparing key by key.
+      runs = []
+      for get, asc_mult in zip(getters, directions):
+        if runs and runs[-1][1] == asc_mult:
+          runs[-1][0].append(get)
+        else:
+          runs.append(([get], asc_mult))
+      for run_getters, asc_mult in reversed(runs):
+        items = DataTable._SortedRun(items, run_getters, asc_mult)
+      return items
+    except TypeError:
+      return sorted(items, key=lambda item: _MixedSortKey(
+          [_SortValue(get(item)) for get in getters], directions))
 
-    return sorted(self.__data, cmp=SortCmpFunc)
+  @staticmethod
+  def _SortedRun(items, getters, asc_mult):
+    """Sorts items by keys that all go in the direction asc_mult."""
+    if len(getters) == 1:
+      get = getters[0]
+      key_func = lambda item: _SortValue(get(item))
+    else:
+      key_func = lambda item: tuple([_SortValue(get(item)) for get in getters])
+    return sorted(items, key=key_func, reverse=asc_mult == -1)
+
+  def _PreparedData(self, order_by=()):
+    """Prepares the data for enumeration - sorting it by order_by.
+
+    Args:
+      order_by: Optional. Specifies the name of the column(s) to sort by, and
+                (optionally) which direction to sort in. Default sort direction
+                is asc. Following formats are accepted:
+                "string_col_name"  -- For a single key in default (asc) order.
+                ("string_col_name", "asc|desc") -- For a single key.
+                [("col_1","asc|desc"), ("col_2","asc|desc")] -- For more than
+                    one column, an array of tuples of (col_name, "asc|desc").
+
+    Returns:
+      The data sorted by the keys given.
+
+    Raises:
+      DataTableException: Sort direction not in 'asc' or 'desc'
+    """
+    if self.__store is not None:
+      return [self.__store.Row(index)
+              for index in self._PreparedIndexes(order_by)]
+
+    if not order_by:
+      return self.__data
+
+    sort_keys = self._SortKeys(order_by)
+    return self._Sorted(self.__data,
+                        [self._RowGetter(key) for key, _ in sort_keys],
+                        [asc_mult for _, asc_mult in sort_keys])
+
+  def _PreparedIndexes(self, order_by=()):
+    """Like _PreparedData(), for columnar storage. Returns row indexes."""
+    indexes = range(self.__store.num_rows)
+    if not order_by:
+      return indexes
+
+    sort_keys = self._SortKeys(order_by)
+    return self._Sorted(indexes,
+                        [self.__store.Getter(key) for key, _ in sort_keys],
+                        [asc_mult for _, asc_mult in sort_keys])
+
+  def _PreparedValues(self, columns_order, order_by=()):
+    """Yields the rows in order as lists of values by columns_order.
+
+    Args:
+      columns_order: The ids of the columns to return, in order.
+      order_by: Optional. Passed as is to _PreparedData().
+
+    Returns:
+      An iterator over the rows sorted by order_by. Each row is a list with
+      the values of the columns in columns_order, None for an empty cell.
+    """
+    if self.__store is not None:
+      getters = [self.__store.Getter(col) for col in columns_order]
+      for index in self._PreparedIndexes(order_by):
+        yield [get(index) for get in getters]
+    else:
+      for row in self._PreparedData(order_by):
+        yield [row.get(col) for col in columns_order]
+
+  @staticmethod
+  def _RowGetter(key):
+    """Returns a function giving the value of column key in a row."""
+    return lambda row: row.get(key)
+
+  def _Encoders(self, columns_order, strict=False):
+    """Returns the value encoders of the given columns, in the same order."""
+    if strict:
+      return [self.__json_encoders[col] for col in columns_order]
+    return [self.__encoders[col] for col in columns_order]
 
   def ToJSCode(self, name, columns_order=None, order_by=()):
     """Writes the data table as a JS code string.
@@ -573,35 +1054,43 @@ class DataTable(object):
     Raises:
       DataTableException: The data does not match the type.
     """
+    return "".join(self.IterJSCode(name, columns_order, order_by))
+
+  def IterJSCode(self, name, columns_order=None, order_by=()):
+    """Like ToJSCode(), but yields the JS code one statement at a time."""
     if columns_order is None:
       columns_order = [col["id"] for col in self.__columns]
     col_dict = dict([(col["id"], col) for col in self.__columns])
 
     # We first create the table with the given name
-    jscode = "var %s = new google.visualization.DataTable();\n" % name
+    yield "var %s = new google.visualization.DataTable();\n" % name
 
     # We add the columns to the table
     for col in columns_order:
-      jscode += "%s.addColumn('%s', '%s', '%s');\n" % (name,
-                                                       col_dict[col]["type"],
-                                                       col_dict[col]["label"],
-                                                       col_dict[col]["id"])
-    jscode += "%s.addRows(%d);\n" % (name, len(self.__data))
+      yield "%s.addColumn('%s', '%s', '%s');\n" % (name,
+                                                   col_dict[col]["type"],
+                                                   col_dict[col]["label"],
+                                                   col_dict[col]["id"])
+    yield "%s.addRows(%d);\n" % (name, self.NumberOfRows())
 
     # We now go over the data and add each row
-    for (i, row) in enumerate(self._PreparedData(order_by)):
+    encoders = self._Encoders(columns_order)
+    for (i, row) in enumerate(self._PreparedValues(columns_order, order_by)):
       # We add all the elements of this row by their order
-      for (j, col) in enumerate(columns_order):
-        if col not in row or row[col] is None:
+      for (j, encoder) in enumerate(encoders):
+        if row[j] is None:
           continue
-        value = self.SingleValueToJS(row[col], col_dict[col]["type"])
+        value = encoder(row[j])
         if isinstance(value, tuple):
           # We have a formatted value as well
-          jscode += ("%s.setCell(%d, %d, %s, %s);\n" %
-                     (name, i, j, value[0], value[1]))
+          yield ("%s.setCell(%d, %d, %s, %s);\n" %
+                 (name, i, j, value[0], value[1]))
         else:
-          jscode += "%s.setCell(%d, %d, %s);\n" % (name, i, j, value)
-    return jscode
+          yield "%s.setCell(%d, %d, %s);\n" % (name, i, j, value)
+
+  def WriteJSCode(self, out, name, columns_order=None, order_by=()):
+    """Like ToJSCode(), but writes the JS code to the file-like object out."""
+    self._Write(out, self.IterJSCode(name, columns_order, order_by))
 
   def ToHtml(self, columns_order=None, order_by=()):
     """Writes the data table as an HTML table code string.
@@ -629,9 +1118,15 @@ class DataTable(object):
     Raises:
       DataTableException: The data does not match the type.
     """
-    table_template = "<html><body><table border='1'>%s</table></body></html>"
+    return "".join(self.IterHtml(columns_order, order_by))
+
+  def IterHtml(self, columns_order=None, order_by=()):
+    """Like ToHtml(), but yields the HTML code a table row at a time."""
+    table_start = "<html><body><table border='1'>"
+    table_end = "</table></body></html>"
     columns_template = "<thead><tr>%s</tr></thead>"
-    rows_template = "<tbody>%s</tbody>"
+    rows_start = "<tbody>"
+    rows_end = "</tbody>"
     row_template = "<tr>%s</tr>"
     header_cell_template = "<th>%s</th>"
     cell_template = "<td>%s</td>"
@@ -643,27 +1138,32 @@ class DataTable(object):
     columns_list = []
     for col in columns_order:
       columns_list.append(header_cell_template % col_dict[col]["label"])
-    columns_html = columns_template % "".join(columns_list)
+    yield table_start
+    yield columns_template % "".join(columns_list)
 
-    rows_list = []
+    yield rows_start
     # We now go over the data and add each row
-    for row in self._PreparedData(order_by):
+    encoders = self._Encoders(columns_order)
+    for row in self._PreparedValues(columns_order, order_by):
       cells_list = []
       # We add all the elements of this row by their order
-      for col in columns_order:
+      for (encoder, cell) in zip(encoders, row):
         # For empty string we want empty quotes ("").
         value = ""
-        if col in row and row[col] is not None:
-          value = self.SingleValueToJS(row[col], col_dict[col]["type"])
+        if cell is not None:
+          value = encoder(cell)
         if isinstance(value, tuple):
           # We have a formatted value and we're going to use it
           cells_list.append(cell_template % cgi.escape(value[1]))
         else:
           cells_list.append(cell_template % cgi.escape(value))
-      rows_list.append(row_template % "".join(cells_list))
-    rows_html = rows_template % "".join(rows_list)
+      yield row_template % "".join(cells_list)
+    yield rows_end
+    yield table_end
 
-    return table_template % (columns_html + rows_html)
+  def WriteHtml(self, out, columns_order=None, order_by=()):
+    """Like ToHtml(), but writes the HTML code to the file-like object out."""
+    self._Write(out, self.IterHtml(columns_order, order_by))
 
   def ToCsv(self, columns_order=None, order_by=()):
     """Writes the data table as a CSV string.
@@ -687,6 +1187,10 @@ class DataTable(object):
     Raises:
       DataTableException: The data does not match the type.
     """
+    return "".join(self.IterCsv(columns_order, order_by))
+
+  def IterCsv(self, columns_order=None, order_by=()):
+    """Like ToCsv(), but yields the CSV a row at a time."""
     if columns_order is None:
       columns_order = [col["id"] for col in self.__columns]
     col_dict = dict([(col["id"], col) for col in self.__columns])
@@ -694,35 +1198,40 @@ class DataTable(object):
     columns_list = []
     for col in columns_order:
       columns_list.append(DataTable._EscapeValue(col_dict[col]["label"]))
-    columns_line = ", ".join(columns_list)
+    yield ", ".join(columns_list)
+    yield "\n"
 
-    rows_list = []
     # We now go over the data and add each row
-    for row in self._PreparedData(order_by):
+    encoders = self._Encoders(columns_order)
+    is_dates = [col_dict[col]["type"] in ["date", "datetime", "timeofday"]
+                for col in columns_order]
+    separator = ""
+    for row in self._PreparedValues(columns_order, order_by):
       cells_list = []
       # We add all the elements of this row by their order
-      for col in columns_order:
+      for (encoder, is_date, cell) in zip(encoders, is_dates, row):
         value = "''"
-        if col in row and row[col] is not None:
-          value = self.SingleValueToJS(row[col], col_dict[col]["type"])
+        if cell is not None:
+          value = encoder(cell)
         if isinstance(value, tuple):
           # We have a formatted value. Using it only for date/time types.
-          if col_dict[col]["type"] in ["date", "datetime", "timeofday"]:
+          if is_date:
             cells_list.append(value[1])
           else:
             cells_list.append(value[0])
         else:
           # We need to quote date types, because they contain commas.
-          if (col_dict[col]["type"] in ["date", "datetime", "timeofday"] and
-              value != "''"):
+          if is_date and value != "''":
             value = "'%s'" % value
           cells_list.append(value)
-      rows_list.append(", ".join(cells_list))
-    rows = "\n".join(rows_list)
+      yield separator + ", ".join(cells_list)
+      separator = "\n"
 
-    return "%s\n%s" % (columns_line, rows)
+  def WriteCsv(self, out, columns_order=None, order_by=()):
+    """Like ToCsv(), but writes the CSV to the file-like object out."""
+    self._Write(out, self.IterCsv(columns_order, order_by))
 
-  def ToJSon(self, columns_order=None, order_by=()):
+  def ToJSon(self, columns_order=None, order_by=(), strict=False):
     """Writes a JSON string that can be used in a JS DataTable constructor.
 
     This method writes a JSON string that can be passed directly into a Google
@@ -745,6 +1254,9 @@ class DataTable(object):
                      if you use it.
       order_by: Optional. Specifies the name of the column(s) to sort by.
                 Passed as is to _PreparedData().
+      strict: Optional. If True, writes strict JSON that a JSON parser can
+              read, with quoted keys and strings, dates as "Date(...)" strings
+              and null for empty cells.
 
     Returns:
       A JSon constructor string to generate a JS DataTable with the data
@@ -754,43 +1266,91 @@ class DataTable(object):
                {id:'b',label:'b',type:'string'},
               {id:'c',label:'c',type:'number'}],
         rows: [{c:[{v:1},{v:'z'},{v:2}]}, c:{[{v:3,f:'3$'},{v:'w'},{v:null}]}]}
+      Example strict result (the result is without the newlines):
+       {"cols":[{"id":"a","label":"a","type":"number"},
+                {"id":"b","label":"b","type":"string"},
+                {"id":"c","label":"c","type":"date"}],
+        "rows":[{"c":[{"v":1},{"v":"z"},{"v":"Date(2009,0,1)"}]},
+                {"c":[{"f":"3$","v":3},{"v":"w"},null]}]}
 
     Raises:
       DataTableException: The data does not match the type.
     """
+    return "".join(self.IterJSon(columns_order, order_by, strict))
+
+  def IterJSon(self, columns_order=None, order_by=(), strict=False):
+    """Like ToJSon(), but yields the JSON string a table row at a time."""
     if columns_order is None:
       columns_order = [col["id"] for col in self.__columns]
     col_dict = dict([(col["id"], col) for col in self.__columns])
 
+    if strict:
+      for chunk in self._IterStrictJSon(columns_order, col_dict, order_by):
+        yield chunk
+      return
+
     # Creating the columns jsons
     cols_jsons = ["{id:'%(id)s',label:'%(label)s',type:'%(type)s'}" %
                   col_dict[col_id] for col_id in columns_order]
 
+    yield "{cols: [%s],rows: [" % ",".join(cols_jsons)
+
     # Creating the rows jsons
-    rows_jsons = []
-    for row in self._PreparedData(order_by):
+    encoders = self._Encoders(columns_order)
+    # We omit the {v:null} for a None value of the not last column
+    null_jsons = [col == columns_order[-1] and "{v:null}" or ""
+                  for col in columns_order]
+    separator = ""
+    for row in self._PreparedValues(columns_order, order_by):
       cells_jsons = []
-      for col in columns_order:
-        # We omit the {v:null} for a None value of the not last column
-        value = row.get(col, None)
-        if value is None and col != columns_order[-1]:
-          cells_jsons.append("")
+      for (encoder, null_json, value) in zip(encoders, null_jsons, row):
+        if value is None:
+          cells_jsons.append(null_json)
         else:
-          value = self.SingleValueToJS(value, col_dict[col]["type"])
+          value = encoder(value)
           if isinstance(value, tuple):
             # We have a formatted value as well
             cells_jsons.append("{v:%s,f:%s}" % value)
           else:
             cells_jsons.append("{v:%s}" % value)
-      rows_jsons.append("{c:[%s]}" % ",".join(cells_jsons))
+      yield "%s{c:[%s]}" % (separator, ",".join(cells_jsons))
+      separator = ","
+    yield "]}"
+
+  def _IterStrictJSon(self, columns_order, col_dict, order_by):
+    """Yields the strict JSON string of IterJSon(), built by the JSON encoder."""
+    encode = _JSON_ENCODER.encode
+    cols = [{"id": col_dict[col_id]["id"],
+             "label": col_dict[col_id]["label"],
+             "type": col_dict[col_id]["type"]} for col_id in columns_order]
+    yield '{"cols":%s,"rows":[' % json.dumps(cols, separators=(",", ":"),
+                                             sort_keys=True)
+
+    encoders = self._Encoders(columns_order, strict=True)
+    separator = ""
+    for row in self._PreparedValues(columns_order, order_by):
+      cells = []
+      for (encoder, value) in zip(encoders, row):
+        if value is None:
+          cells.append(None)
+          continue
+        value = encoder(value)
+        if isinstance(value, tuple):
+          # We have a formatted value as well
+          cells.append({"v": value[0], "f": value[1]})
+        else:
+          cells.append({"v": value})
+      yield separator + encode({"c": cells})
+      separator = ","
+    yield "]}"
 
-    # We now join the columns jsons and the rows jsons
-    json = "{cols: [%s],rows: [%s]}" % (",".join(cols_jsons),
-                                        ",".join(rows_jsons))
-    return json
+  def WriteJSon(self, out, columns_order=None, order_by=(), strict=False):
+    """Like ToJSon(), but writes the JSON string to the file-like object out."""
+    self._Write(out, self.IterJSon(columns_order, order_by, strict))
 
   def ToJSonResponse(self, columns_order=None, order_by=(), req_id=0,
-                     response_handler="google.visualization.Query.setResponse"):
+                     response_handler="google.visualization.Query.setResponse",
+                     strict=False):
     """Writes a table as a JSON response that can be returned as-is to a client.
 
     This method writes a JSON response to return to a client in response to a
@@ -804,6 +1364,8 @@ class DataTable(object):
       req_id: Optional. The response id, as retrieved by the request.
       response_handler: Optional. The response handler, as retrieved by the
           request.
+      strict: Optional. Passed straight to self.ToJSon(). The response object
+          around the table is strict JSON as well.
 
     Returns:
       A JSON response string to be received by JS the visualization Query
@@ -817,11 +1379,33 @@ class DataTable(object):
     Note: The URL returning this string can be used as a data source by Google
           Visualization Gadgets or from JS code.
     """
-    table = self.ToJSon(columns_order, order_by)
-    return ("%s({'version':'0.5', 'reqId':'%s', 'status':'OK', "
-            "'table': %s});") % (response_handler, req_id, table)
-
-  def ToResponse(self, columns_order=None, order_by=(), tqx=""):
+    return "".join(self.IterJSonResponse(columns_order, order_by, req_id,
+                                         response_handler, strict))
+
+  def IterJSonResponse(self, columns_order=None, order_by=(), req_id=0,
+                       response_handler=
+                       "google.visualization.Query.setResponse",
+                       strict=False):
+    """Like ToJSonResponse(), but yields the response a table row at a time."""
+    if strict:
+      yield '%s({"version":"0.5","reqId":%s,"status":"OK","table":' % (
+          response_handler, _JSON_ENCODER.encode("%s" % req_id))
+    else:
+      yield ("%s({'version':'0.5', 'reqId':'%s', 'status':'OK', "
+             "'table': ") % (response_handler, req_id)
+    for chunk in self.IterJSon(columns_order, order_by, strict):
+      yield chunk
+    yield "});"
+
+  def WriteJSonResponse(self, out, columns_order=None, order_by=(), req_id=0,
+                        response_handler=
+                        "google.visualization.Query.setResponse",
+                        strict=False):
+    """Like ToJSonResponse(), but writes the response to the file-like out."""
+    self._Write(out, self.IterJSonResponse(columns_order, order_by, req_id,
+                                           response_handler, strict))
+
+  def ToResponse(self, columns_order=None, order_by=(), tqx="", strict=False):
     """Writes the right response according to the request string passed in tqx.
 
     This method parses the tqx request string (format of which is defined in
@@ -838,10 +1422,32 @@ class DataTable(object):
            the format "key1:value1;key2:value2...". All keys have a default
            value, so an empty string will just do the default (which is calling
            ToJSonResponse() with no extra parameters).
+      strict: Optional. Passed as is to ToJSonResponse().
 
     Returns:
       A response string, as returned by the relevant response function.
 
+    Raises:
+      DataTableException: One of the parameters passed in tqx is not supported.
+    """
+    return "".join(self.IterResponse(columns_order, order_by, tqx, strict))
+
+  def IterResponse(self, columns_order=None, order_by=(), tqx="",
+                   strict=False):
+    """Like ToResponse(), but returns an iterator over the response chunks.
+
+    The tqx string is parsed before the iterator is returned, so an
+    unsupported parameter raises before any of the response is produced.
+
+    Args:
+      columns_order: Optional. Passed as is to the relevant response function.
+      order_by: Optional. Passed as is to the relevant response function.
+      tqx: Optional. The request string, as in ToResponse().
+      strict: Optional. Passed as is to IterJSonResponse().
+
+    Returns:
+      An iterator over the chunks of the response string.
+
     Raises:
       DataTableException: One of the parameters passed in tqx is not supported.
     """
@@ -856,13 +1462,43 @@ class DataTable(object):
     if tqx_dict.get("out", "json") == "json":
       response_handler = tqx_dict.get("responseHandler",
                                       "google.visualization.Query.setResponse")
-      return self.ToJSonResponse(columns_order, order_by,
-                                 req_id=tqx_dict.get("reqId", 0),
-                                 response_handler=response_handler)
+      return self.IterJSonResponse(columns_order, order_by,
+                                   req_id=tqx_dict.get("reqId", 0),
+                                   response_handler=response_handler,
+                                   strict=strict)
     elif tqx_dict["out"] == "html":
-      return self.ToHtml(columns_order, order_by)
+      return self.IterHtml(columns_order, order_by)
     elif tqx_dict["out"] == "csv":
-      return self.ToCsv(columns_order, order_by)
+      return self.IterCsv(columns_order, order_by)
     else:
       raise DataTableException(
           "'out' parameter: '%s' is not supported" % tqx_dict["out"])
+
+  def WriteResponse(self, out, columns_order=None, order_by=(), tqx="",
+                    strict=False):
+    """Like ToResponse(), but writes the response to the file-like object out.
+
+    Writing the response as it is built saves holding the whole response
+    string in memory, e.g. when passing a webapp handler's self.response.out.
+
+    Args:
+      out: A file-like object with a write() method.
+      columns_order: Optional. Passed as is to the relevant response function.
+      order_by: Optional. Passed as is to the relevant response function.
+      tqx: Optional. The request string, as in ToResponse().
+      strict: Optional. Passed as is to IterJSonResponse().
+
+    Raises:
+      DataTableException: One of the parameters passed in tqx is not supported.
+          Nothing is written to out in this case.
+      DataTableException: The data does not match the type. The response
+          written to out up to the failing cell is left there.
+    """
+    self._Write(out, self.IterResponse(columns_order, order_by, tqx, strict))
+
+  @staticmethod
+  def _Write(out, chunks):
+    """Writes each of the string chunks to the file-like object out."""
+    write = out.write
+    for chunk in chunks:
+      write(chunk)
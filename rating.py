@@ -0,0 +1,467 @@
+import math
+from array import array
+
+ELO_DEFAULT_RATING = 1500
+ELO_MATCH_WEIGHT = 50.0
+ELO_DIVIDE_FACTOR = 400.0
+PROVISIONAL_PROTECTION = 2.0
+PROVISIONAL_NUM_GAMES = 6
+
+# per player stats tracked by a replay, named as on UserRecord
+STAT_COLUMNS = ('rating', 'ratingChange', 'wins', 'draws', 'losses', 'goalsfor', 'goalsagainst', 'isProvisional')
+
+# both players' state around a game, stored on GameRecord so a game can be rolled back. the games played
+# after it tell whether the game is still a player's latest, a later game can leave the rating as it was
+LEDGER_FIELDS = ('winner_rating_before', 'winner_rating_after', 'winner_change_before', 'winner_provisional_before', 'winner_provisional_after',
+                 'loser_rating_before', 'loser_rating_after', 'loser_change_before', 'loser_provisional_before', 'loser_provisional_after',
+                 'winner_games_after', 'loser_games_after')
+
+# ------------------- Elo Rating Functions ---------------------------------------------------------------------------
+# based on formula taken from World Football Elo Rating System at eloratings.net
+#       Rn = Ro + K x (W - We)
+# where Rn is the new rating
+#       Ro is the old (pre-match) rating
+#       K is match weight
+#       W is result of game (1 for a win, 0.5 for a draw, and 0 for a loss)
+#       We is expected Result
+#
+def CalcExpectedResult(playerRating, opponentRating):
+    expectedResult = 1.0 / (1.0 + pow(10, (opponentRating - playerRating) / ELO_DIVIDE_FACTOR ))
+    return expectedResult
+
+def CalcMatchWeight(goalDifference):
+    weight = ELO_MATCH_WEIGHT
+    if goalDifference >= 4:
+        weight *= 1.75 + (goalDifference - 3) / 8.0
+    elif goalDifference >= 3:
+        weight *= 1.75
+    elif goalDifference >= 2:
+        weight *= 1.5
+    return weight
+
+def CalcRatingChange(playerRating, opponentRating, result, goalDifference, isProtected):
+
+    protection = 1.0
+    if( isProtected ):
+        protection = PROVISIONAL_PROTECTION
+
+    matchWeight = CalcMatchWeight(goalDifference)
+    expectedResult = CalcExpectedResult(playerRating, opponentRating)
+    resultDiff = result - expectedResult
+    ratingChange = (resultDiff * matchWeight) / protection
+
+    #logging.debug("Rating Calc Input: pr:%d or:%d result:%.2f, gd:%d", playerRating, opponentRating, result, goalDifference)
+    #logging.debug("Rating Calc Output: mw:%.2f er:%.2f rc:%.2f", matchWeight, expectedResult, ratingChange)
+    return ratingChange
+
+# ------------------- Game Ledger ------------------------------------------------------------------------------------
+def GetLedger(game):
+    return tuple([getattr(game, name, None) for name in LEDGER_FIELDS])
+
+def SetLedger(game, ledger):
+    for name, value in zip(LEDGER_FIELDS, ledger):
+        setattr(game, name, value)
+
+# the rating change a game made, from a ledger's before and after ratings. a player's first game starts
+# from the default rating, stored as 0 before it
+def LedgerChange(before, after):
+    return after - (before or ELO_DEFAULT_RATING)
+
+# games reported before the ledger existed carry no before/after values
+def HasLedger(game):
+    return getattr(game, 'winner_rating_before', None) is not None
+
+# ------------------- Batch Replay Engine ----------------------------------------------------------------------------
+# replays a game history in memory. per player state lives in parallel arrays indexed by
+# player slot, so a full replay touches no entities until the results are written back.
+# ApplyGame is also the update UpdateRatingScore runs for a single reported game.
+class RatingReplay(object):
+
+    def __init__(self):
+        self.slots = {}
+        self.players = []
+        self.rating = array('l')
+        self.ratingChange = array('l')
+        self.wins = array('l')
+        self.draws = array('l')
+        self.losses = array('l')
+        self.goalsfor = array('l')
+        self.goalsagainst = array('l')
+        self.isProvisional = array('b')
+
+    def AddPlayer(self, player, rating=0, ratingChange=0, wins=0, draws=0, losses=0, goalsfor=0, goalsagainst=0, isProvisional=True):
+        slot = self.slots.get(player)
+        if slot is None:
+            slot = len(self.players)
+            self.slots[player] = slot
+            self.players.append(player)
+            for column in (self.rating, self.ratingChange, self.wins, self.draws, self.losses, self.goalsfor, self.goalsagainst, self.isProvisional):
+                column.append(0)
+        self.rating[slot] = rating
+        self.ratingChange[slot] = ratingChange
+        self.wins[slot] = wins
+        self.draws[slot] = draws
+        self.losses[slot] = losses
+        self.goalsfor[slot] = goalsfor
+        self.goalsagainst[slot] = goalsagainst
+        self.isProvisional[slot] = isProvisional
+        return slot
+
+    def Slot(self, player):
+        slot = self.slots.get(player)
+        if slot is None:
+            slot = self.AddPlayer(player)
+        return slot
+
+    # applies one game and returns its ledger, the values for LEDGER_FIELDS
+    def ApplyGame(self, winnerPlayer, loserPlayer, tie, winnerScore, loserScore):
+        winner = self.Slot(winnerPlayer)
+        loser = self.Slot(loserPlayer)
+        rating = self.rating
+        isProvisional = self.isProvisional
+
+        winnerBefore = (rating[winner], self.ratingChange[winner], bool(isProvisional[winner]))
+        loserBefore = (rating[loser], self.ratingChange[loser], bool(isProvisional[loser]))
+
+        loserProtection = isProvisional[winner] and not isProvisional[loser]
+
+        winnerRating = rating[winner]
+        if winnerRating == 0:
+            winnerRating = ELO_DEFAULT_RATING
+        loserRating = rating[loser]
+        if loserRating == 0:
+            loserRating = ELO_DEFAULT_RATING
+
+        winnerRatingChange = int(CalcRatingChange(winnerRating, loserRating, 1.0 if not tie else 0.5, winnerScore - loserScore, False))
+        loserRatingChange = int(CalcRatingChange(loserRating, winnerRating, 0.0 if not tie else 0.5, loserScore - winnerScore, loserProtection))
+
+        # a self reported game (winner == loser) is read twice from the same record and the
+        # loser's put lands last, so only the loser side is applied
+        if winner != loser:
+            self.ratingChange[winner] = winnerRatingChange
+            rating[winner] = winnerRating + winnerRatingChange
+            self.goalsfor[winner] += winnerScore
+            self.goalsagainst[winner] += loserScore
+            if tie:
+                self.draws[winner] += 1
+            else:
+                self.wins[winner] += 1
+            isProvisional[winner] = self.wins[winner] + self.draws[winner] + self.losses[winner] < PROVISIONAL_NUM_GAMES
+
+        self.ratingChange[loser] = loserRatingChange
+        rating[loser] = loserRating + loserRatingChange
+        self.goalsfor[loser] += loserScore
+        self.goalsagainst[loser] += winnerScore
+        if tie:
+            self.draws[loser] += 1
+        else:
+            self.losses[loser] += 1
+        isProvisional[loser] = self.wins[loser] + self.draws[loser] + self.losses[loser] < PROVISIONAL_NUM_GAMES
+
+        return (winnerBefore[0], rating[winner], winnerBefore[1], winnerBefore[2], bool(isProvisional[winner]),
+                loserBefore[0], rating[loser], loserBefore[1], loserBefore[2], bool(isProvisional[loser]),
+                self.wins[winner] + self.draws[winner] + self.losses[winner], self.wins[loser] + self.draws[loser] + self.losses[loser])
+
+    # reverses ApplyGame given the ledger it returned, valid while the game is the latest for both players
+    def UndoGame(self, winnerPlayer, loserPlayer, tie, winnerScore, loserScore, ledger):
+        winner = self.Slot(winnerPlayer)
+        loser = self.Slot(loserPlayer)
+
+        self.rating[loser] = ledger[5]
+        self.ratingChange[loser] = ledger[7]
+        self.isProvisional[loser] = ledger[8]
+        self.goalsfor[loser] -= loserScore
+        self.goalsagainst[loser] -= winnerScore
+        if tie:
+            self.draws[loser] -= 1
+        else:
+            self.losses[loser] -= 1
+
+        if winner != loser:
+            self.rating[winner] = ledger[0]
+            self.ratingChange[winner] = ledger[2]
+            self.isProvisional[winner] = ledger[3]
+            self.goalsfor[winner] -= winnerScore
+            self.goalsagainst[winner] -= loserScore
+            if tie:
+                self.draws[winner] -= 1
+            else:
+                self.wins[winner] -= 1
+
+    # games are anything with GameRecord's winner/loser/tie/score attributes, oldest first.
+    # with 'changed' given, each game's ledger fields are refreshed and the games whose
+    # ledger differed from the stored one are appended to it
+    def Replay(self, games, changed=None):
+        applyGame = self.ApplyGame
+        count = 0
+        for game in games:
+            ledger = applyGame(game.winner, game.loser, game.tie, game.winner_score, game.loser_score)
+            if changed is not None and ledger != GetLedger(game):
+                SetLedger(game, ledger)
+                changed.append(game)
+            count += 1
+        return count
+
+    # the whole player state as plain lists, e.g. for storing a checkpoint
+    def Snapshot(self):
+        snapshot = {'players': list(self.players)}
+        for name in STAT_COLUMNS:
+            snapshot[name] = getattr(self, name).tolist()
+        return snapshot
+
+    @staticmethod
+    def FromSnapshot(snapshot):
+        replay = RatingReplay()
+        replay.players = list(snapshot['players'])
+        replay.slots = dict([(player, slot) for slot, player in enumerate(replay.players)])
+        for name in STAT_COLUMNS:
+            column = getattr(replay, name)
+            column.fromlist([int(value) for value in snapshot[name]])
+        return replay
+
+    def PlayerStats(self, player):
+        slot = self.slots[player]
+        return {'rating': self.rating[slot],
+                'ratingChange': self.ratingChange[slot],
+                'wins': self.wins[slot],
+                'draws': self.draws[slot],
+                'losses': self.losses[slot],
+                'goalsfor': self.goalsfor[slot],
+                'goalsagainst': self.goalsagainst[slot],
+                'isProvisional': bool(self.isProvisional[slot])}
+
+# ------------------- Rank Index -------------------------------------------------------------------------------------
+# a count of players per rating kept as a fenwick tree, so the rank of a rating and the rating at a rank
+# are both O(log n) and moving a player is O(log n). the tree runs from the highest rating down, so
+# its prefix sums count the players rated above a rating
+RANK_INDEX_SIZE = 4096
+
+class RankIndex(object):
+
+    def __init__(self, tree=None):
+        if tree is None:
+            tree = [0] * RANK_INDEX_SIZE
+        self.tree = list(tree)
+
+    # tree position of a rating, ratings outside the index range share the end slots
+    def Position(self, rating):
+        rating = min(max(int(rating), 0), RANK_INDEX_SIZE - 1)
+        return RANK_INDEX_SIZE - rating
+
+    def Add(self, rating, count=1):
+        tree = self.tree
+        position = self.Position(rating)
+        while position <= RANK_INDEX_SIZE:
+            tree[position - 1] += count
+            position += position & -position
+
+    def Move(self, oldRating, newRating):
+        if self.Position(oldRating) != self.Position(newRating):
+            self.Add(oldRating, -1)
+            self.Add(newRating)
+
+    # players rated at or above 'rating'
+    def CountFrom(self, rating):
+        tree = self.tree
+        position = self.Position(rating)
+        count = 0
+        while position > 0:
+            count += tree[position - 1]
+            position -= position & -position
+        return count
+
+    def CountAbove(self, rating):
+        if int(rating) >= RANK_INDEX_SIZE - 1:
+            return 0
+        return self.CountFrom(int(rating) + 1)
+
+    def Total(self):
+        return self.CountFrom(0)
+
+    # standings rank of a rating, players on the same rating share it
+    def Rank(self, rating):
+        return self.CountAbove(rating) + 1
+
+    # the rating of the player at standings position 'rank' (1 is the top), None past the last player
+    def RatingAt(self, rank):
+        tree = self.tree
+        position = 0
+        step = RANK_INDEX_SIZE
+        while step:
+            if position + step <= RANK_INDEX_SIZE and tree[position + step - 1] < rank:
+                position += step
+                rank -= tree[position - 1]
+            step >>= 1
+        if position >= RANK_INDEX_SIZE:
+            return None
+        return RANK_INDEX_SIZE - 1 - position
+
+    @staticmethod
+    def FromRatings(ratings):
+        index = RankIndex()
+        tree = index.tree
+        for rating in ratings:
+            tree[index.Position(rating) - 1] += 1
+        # turn the per slot counts into the tree in one pass
+        for position in range(1, RANK_INDEX_SIZE + 1):
+            parent = position + (position & -position)
+            if parent <= RANK_INDEX_SIZE:
+                tree[parent - 1] += tree[position - 1]
+        return index
+
+# ------------------- Rating Engines ---------------------------------------------------------------------------------
+# an engine rates a whole game history in one pass. RateHistory takes games oldest first (anything with
+# GameRecord's winner/loser/tie/score/date attributes) and returns each player's stats as a dict, rating
+# the games played up to 'until'. an engine that rates game by game also hands out the replay the live
+# updates, undos and resimulations run on, fresh or from a RatingReplay snapshot
+class RatingEngine(object):
+    name = None
+
+    def RateHistory(self, games, until=None):
+        raise NotImplementedError
+
+    def NewReplay(self, snapshot=None):
+        raise NotImplementedError
+
+# today's elo, every game rated as it is reported. a game is final once played, so 'until' changes nothing
+class EloEngine(RatingEngine):
+    name = 'elo'
+
+    def RateHistory(self, games, until=None):
+        replay = self.NewReplay()
+        replay.Replay(games)
+        return dict([(player, replay.PlayerStats(player)) for player in replay.players])
+
+    def NewReplay(self, snapshot=None):
+        if snapshot is None:
+            return RatingReplay()
+        return RatingReplay.FromSnapshot(snapshot)
+
+# glicko-2 as described in Glickman's "Example of the Glicko-2 system". games are rated in periods of
+# GLICKO_PERIOD_DAYS, every game of a period against the opponents' ratings from the start of it
+GLICKO_DEFAULT_RATING = 1500.0
+GLICKO_DEFAULT_RD = 350.0
+GLICKO_DEFAULT_VOLATILITY = 0.06
+GLICKO_TAU = 0.5
+GLICKO_EPSILON = 0.000001
+GLICKO_SCALE = 173.7178
+GLICKO_PERIOD_DAYS = 7
+
+class Glicko2Engine(RatingEngine):
+    name = 'glicko2'
+
+    def __init__(self, periodDays=GLICKO_PERIOD_DAYS):
+        self.periodDays = periodDays
+
+    # periods start on a monday (ordinal 1 is one), the day cron closes them
+    def Period(self, date):
+        return (date.toordinal() - 1) // self.periodDays
+
+    # the games stream past once, a period is rated as soon as the first game of the next one shows up.
+    # the last period is only rated once it has closed by 'until', games in a still open one wait for
+    # the next run. without 'until' every period is treated as closed
+    def RateHistory(self, games, until=None):
+        players = {}
+        period = None
+        results = {}
+        for game in games:
+            gamePeriod = self.Period(game.date)
+            if gamePeriod != period:
+                if period is not None:
+                    self.RatePeriod(players, results, gamePeriod - period)
+                period = gamePeriod
+                results = {}
+            if game.winner == game.loser:
+                continue
+            for player in (game.winner, game.loser):
+                if player not in players:
+                    players[player] = (0.0, GLICKO_DEFAULT_RD / GLICKO_SCALE, GLICKO_DEFAULT_VOLATILITY)
+            if game.tie:
+                winnerScore = 0.5
+            else:
+                winnerScore = 1.0
+            results.setdefault(game.winner, []).append((game.loser, winnerScore))
+            results.setdefault(game.loser, []).append((game.winner, 1.0 - winnerScore))
+        if period is not None:
+            if until is None:
+                self.RatePeriod(players, results, 1)
+            elif self.Period(until) > period:
+                self.RatePeriod(players, results, self.Period(until) - period)
+
+        stats = {}
+        for player, (mu, phi, sigma) in players.items():
+            stats[player] = {'rating': mu * GLICKO_SCALE + GLICKO_DEFAULT_RATING,
+                             'rd': phi * GLICKO_SCALE,
+                             'volatility': sigma}
+        return stats
+
+    # rate one period in place. 'periods' is how many periods it spans up to the next game, players
+    # sit out the empty ones and their deviation grows for each
+    def RatePeriod(self, players, results, periods):
+        rated = {}
+        for player, (mu, phi, sigma) in players.items():
+            games = results.get(player)
+            idlePeriods = periods
+            if games:
+                mu, phi, sigma = self.RatePlayer(mu, phi, sigma, [players[opponent] + (score,) for opponent, score in games])
+                idlePeriods -= 1
+            for i in range(idlePeriods):
+                phi = min(math.sqrt(phi * phi + sigma * sigma), GLICKO_DEFAULT_RD / GLICKO_SCALE)
+            rated[player] = (mu, phi, sigma)
+        players.update(rated)
+
+    def RatePlayer(self, mu, phi, sigma, games):
+        variance = 0.0
+        improvement = 0.0
+        for opponentMu, opponentPhi, opponentSigma, score in games:
+            g = 1.0 / math.sqrt(1.0 + 3.0 * opponentPhi * opponentPhi / (math.pi * math.pi))
+            expected = 1.0 / (1.0 + math.exp(-g * (mu - opponentMu)))
+            variance += g * g * expected * (1.0 - expected)
+            improvement += g * (score - expected)
+        variance = 1.0 / variance
+        delta = variance * improvement
+
+        sigma = self.Volatility(phi, sigma, variance, delta)
+        phiStar = math.sqrt(phi * phi + sigma * sigma)
+        phi = 1.0 / math.sqrt(1.0 / (phiStar * phiStar) + 1.0 / variance)
+        mu = mu + phi * phi * improvement
+        return mu, phi, sigma
+
+    # the new volatility, solved with the illinois algorithm (step 5 of the paper)
+    def Volatility(self, phi, sigma, variance, delta):
+        a = math.log(sigma * sigma)
+        def f(x):
+            ex = math.exp(x)
+            return (ex * (delta * delta - phi * phi - variance - ex) / (2.0 * (phi * phi + variance + ex) ** 2)
+                    - (x - a) / (GLICKO_TAU * GLICKO_TAU))
+
+        A = a
+        if delta * delta > phi * phi + variance:
+            B = math.log(delta * delta - phi * phi - variance)
+        else:
+            k = 1
+            while f(a - k * GLICKO_TAU) < 0:
+                k += 1
+            B = a - k * GLICKO_TAU
+
+        fA = f(A)
+        fB = f(B)
+        while abs(B - A) > GLICKO_EPSILON:
+            C = A + (A - B) * fA / (fB - fA)
+            fC = f(C)
+            if fC * fB < 0:
+                A = B
+                fA = fB
+            else:
+                fA = fA / 2.0
+            B = C
+            fB = fC
+        return math.exp(A / 2.0)
+
+ENGINES = {
+    EloEngine.name: EloEngine(),
+    Glicko2Engine.name: Glicko2Engine(),
+}
+
+def GetEngine(name):
+    return ENGINES[name]
@@ -0,0 +1,116 @@
+# offline sweep of the elo parameters over an exported game history, run with:
+#   appcfg.py download_data --config_file=data_loader.py --kind=GameRecord --filename=games.csv <app dir>
+#   python sweep.py games.csv
+# every setting replays the whole history and is scored by how well CalcExpectedResult predicted each game
+import csv
+import datetime
+import itertools
+import math
+import multiprocessing
+import optparse
+import sys
+import time
+
+import rating
+
+MATCH_WEIGHTS = (30.0, 40.0, 50.0, 60.0, 70.0)
+DIVIDE_FACTORS = (300.0, 400.0, 500.0)
+PROVISIONAL_PROTECTIONS = (1.0, 2.0, 3.0)
+PROVISIONAL_NUM_GAMES = (3, 6, 10)
+
+# keeps log(0) out of the log loss for a prediction of exactly 0 or 1
+MIN_PROBABILITY = 1e-12
+
+# ------------------- Game History -----------------------------------------------------------------------------------
+class ExportedGame(object):
+    def __init__(self, winner, loser, tie, date, winner_score, loser_score):
+        self.winner = winner
+        self.loser = loser
+        self.tie = tie
+        self.date = date
+        self.winner_score = winner_score
+        self.loser_score = loser_score
+
+# the games of a GameExporter csv (see data_loader.py), oldest first
+def LoadGames(filename, ladder=None):
+    games = []
+    for row in csv.reader(open(filename, 'rb')):
+        ladderName, winner, loser, tie, date, winnerScore, loserScore = row[:7]
+        if ladder and ladderName != ladder:
+            continue
+        date = datetime.datetime.strptime(date.split('.')[0], '%Y-%m-%d %H:%M:%S')
+        games.append(ExportedGame(winner, loser, tie == 'True', date, int(winnerScore), int(loserScore)))
+    games.sort(key=lambda game: game.date)
+    return games
+
+# ------------------- Scoring ----------------------------------------------------------------------------------------
+# replay 'games' with one parameter setting and score the expected result of every game against its result
+# (1 for the winner, 0.5 for a draw). the module constants are set per call, each pool process runs one
+# setting at a time
+def ScoreSetting(setting):
+    matchWeight, divideFactor, protection, numGames = setting
+    rating.ELO_MATCH_WEIGHT = matchWeight
+    rating.ELO_DIVIDE_FACTOR = divideFactor
+    rating.PROVISIONAL_PROTECTION = protection
+    rating.PROVISIONAL_NUM_GAMES = numGames
+
+    start = time.time()
+    replay = rating.RatingReplay()
+    ratings = replay.rating
+    logLoss = 0.0
+    brier = 0.0
+    scored = 0
+    for game in GAMES:
+        winner = replay.Slot(game.winner)
+        loser = replay.Slot(game.loser)
+        if winner != loser:
+            expected = rating.CalcExpectedResult(ratings[winner] or rating.ELO_DEFAULT_RATING, ratings[loser] or rating.ELO_DEFAULT_RATING)
+            expected = min(max(expected, MIN_PROBABILITY), 1.0 - MIN_PROBABILITY)
+            result = game.tie and 0.5 or 1.0
+            logLoss -= result * math.log(expected) + (1.0 - result) * math.log(1.0 - expected)
+            brier += (expected - result) ** 2
+            scored += 1
+        replay.ApplyGame(game.winner, game.loser, game.tie, game.winner_score, game.loser_score)
+
+    scored = scored or 1
+    return setting, logLoss / scored, brier / scored, time.time() - start
+
+# the history is handed to the pool processes once, when they start
+GAMES = []
+
+def InitWorker(games):
+    global GAMES
+    GAMES = games
+
+def Sweep(games, processes=None):
+    settings = list(itertools.product(MATCH_WEIGHTS, DIVIDE_FACTORS, PROVISIONAL_PROTECTIONS, PROVISIONAL_NUM_GAMES))
+    pool = multiprocessing.Pool(processes, InitWorker, (games,))
+    start = time.time()
+    try:
+        results = pool.map(ScoreSetting, settings, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return results, time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] games.csv")
+    parser.add_option("-p", "--processes", type="int", help="pool size, defaults to the number of cpus")
+    parser.add_option("-l", "--ladder", help="only replay the games of this ladder")
+    parser.add_option("-n", "--top", type="int", default=10, help="number of settings to list")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected the exported game csv")
+
+    games = LoadGames(args[0], options.ladder)
+    results, elapsed = Sweep(games, options.processes)
+    results.sort(key=lambda result: result[1])
+
+    print("%d settings over %d games in %.2fs" % (len(results), len(games), elapsed))
+    print("  %.1f replays/s, %.0f games/s" % (len(results) / elapsed, len(results) * len(games) / elapsed))
+    print("  %8s %8s %10s %12s %10s %8s" % ("weight", "divide", "protection", "provisional", "log loss", "brier"))
+    for setting, logLoss, brier, seconds in results[:options.top]:
+        print("  %8.1f %8.1f %10.1f %12d %10.5f %8.5f" % (setting + (logLoss, brier)))
+
+if __name__ == "__main__":
+    main()
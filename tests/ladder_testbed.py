@@ -0,0 +1,88 @@
+# shared setup for the tests that run the ladder against the app engine sdk's local services. the sdk is
+# found through APPENGINE_SDK, without it those tests are skipped
+import datetime
+import imp
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine'))
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.api import users
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+except ImportError:
+    testbed = None
+
+import rating
+
+ladder = None
+if testbed is not None:
+    ladder = imp.load_source('game_ladder', os.path.join(ROOT, 'game-ladder.py'))
+
+START_DATE = datetime.datetime(2010, 5, 1, 20, 0, 0)
+
+def Player(i):
+    return users.User("player%d@example.com" % i)
+
+# every task the ladder adds runs through a LocalTaskQueue, and the datastore runs with the high
+# replication consistency the cross group transactions need
+class LadderTestCase(unittest.TestCase):
+    # small chunks and checkpoint intervals so a few dozen games span several of each. a chunk ends on
+    # a checkpoint, as the next chunk starts from it
+    RESIMULATE_CHUNK_SIZE = 10
+    CHECKPOINT_INTERVAL = 5
+    INGEST_BATCH_SIZE = 4
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id = 'game-ladder', user_email = 'player0@example.com', overwrite = True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability = 1)
+        self.testbed.init_datastore_v3_stub(consistency_policy = policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+
+        self.saved = {}
+        for name in ('RESIMULATE_CHUNK_SIZE', 'CHECKPOINT_INTERVAL', 'INGEST_BATCH_SIZE', 'task_queue'):
+            self.saved[name] = getattr(ladder, name)
+        ladder.RESIMULATE_CHUNK_SIZE = self.RESIMULATE_CHUNK_SIZE
+        ladder.CHECKPOINT_INTERVAL = self.CHECKPOINT_INTERVAL
+        ladder.INGEST_BATCH_SIZE = self.INGEST_BATCH_SIZE
+        self.queue = ladder.task_queue = ladder.LocalTaskQueue()
+        ladder.standings_cache.local = {}
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(ladder, name, value)
+        self.testbed.deactivate()
+
+    # games between the first 'numPlayers' players, one minute apart. a few are draws
+    def MakeGames(self, numGames, numPlayers=5):
+        games = []
+        for i in range(numGames):
+            winner = Player(i % numPlayers)
+            loser = Player((i * 3 + 1) % numPlayers)
+            if winner == loser:
+                loser = Player((i + 1) % numPlayers)
+            games.append((START_DATE + datetime.timedelta(minutes = i), winner, loser, i % 7 == 3, 2 + i % 3, i % 2))
+        return games
+
+    def GetGames(self):
+        return list(ladder.GameRecord.all().filter("ladder =", ladder.ladder_name).order('date'))
+
+    # the records must hold what a full replay of the stored games gives, and every game its ledger
+    def assertRecordsMatchReplay(self):
+        games = self.GetGames()
+        replay = rating.GetEngine('elo').NewReplay()
+        changed = []
+        replay.Replay(games, changed)
+        self.assertEqual([], [game.key().name() for game in changed])
+        for player in replay.players:
+            self.assertEqual(replay.PlayerStats(player), ladder.GetRecordStats(ladder.GetUserRecord(player)))
+        return replay
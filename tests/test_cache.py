@@ -0,0 +1,67 @@
+# the standings cache in front of memcache, its hit ratio and invalidation by version. runs without the sdk.
+# run from the repository root with: python -m unittest discover -s tests -t .
+import time
+import unittest
+
+import cache
+
+class VersionedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.memcache = cache.LocalMemcache()
+        self.cache = cache.VersionedCache(self.memcache)
+        self.computed = []
+
+    def Compute(self, value):
+        def compute():
+            self.computed.append(value)
+            return value
+        return compute
+
+    def testRepeatedReadsHitTheLocalLevel(self):
+        for i in range(10):
+            self.assertEqual([1, 2], self.cache.Get('ladder', 'standings', self.Compute([1, 2])))
+        self.assertEqual(1, len(self.computed))
+        self.assertEqual((9, 0, 1), (self.cache.localHits, self.cache.memcacheHits, self.cache.misses))
+        self.assertEqual(0.9, self.cache.HitRatio())
+
+    def testAnotherInstanceHitsMemcache(self):
+        self.cache.Get('ladder', 'standings', self.Compute('first'))
+        other = cache.VersionedCache(self.memcache)
+        self.assertEqual('first', other.Get('ladder', 'standings', self.Compute('second')))
+        self.assertEqual(['first'], self.computed)
+        self.assertEqual((0, 1, 0), (other.localHits, other.memcacheHits, other.misses))
+
+    def testBumpingTheVersionInvalidatesEveryInstance(self):
+        other = cache.VersionedCache(self.memcache)
+        self.cache.Get('ladder', 'standings', self.Compute('before'))
+        other.Get('ladder', 'standings', self.Compute('before'))
+        other.BumpVersion('ladder')
+        self.assertEqual('after', self.cache.Get('ladder', 'standings', self.Compute('after')))
+        self.assertEqual('after', other.Get('ladder', 'standings', self.Compute('again')))
+        self.assertEqual(['before', 'after'], self.computed)
+        # other ladders keep their entries
+        self.cache.Get('other', 'standings', self.Compute('other'))
+        self.cache.BumpVersion('ladder')
+        self.assertEqual('other', self.cache.Get('other', 'standings', self.Compute('recomputed')))
+
+    def testAnEvictedVersionDoesNotReuseEntries(self):
+        self.cache.Get('ladder', 'standings', self.Compute('before'))
+        version = self.cache.GetVersion('ladder')
+        self.memcache.delete(self.cache.VersionKey('ladder'))
+        # the version restarts from the clock, which has moved on since the first one
+        time.sleep(0.01)
+        self.assertTrue(self.cache.GetVersion('ladder') > version)
+        self.assertEqual('after', self.cache.Get('ladder', 'standings', self.Compute('after')))
+
+    def testTheLocalLevelIsBounded(self):
+        small = cache.VersionedCache(self.memcache, maxLocalEntries = 3)
+        for i in range(10):
+            small.Get('ladder', 'page%d' % i, self.Compute(i))
+        self.assertTrue(len(small.local) <= 3)
+
+    def testNoLookupsIsNoHits(self):
+        self.assertEqual(0.0, self.cache.HitRatio())
+
+if __name__ == '__main__':
+    unittest.main()
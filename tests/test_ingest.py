@@ -0,0 +1,76 @@
+# match ingestion, reports queued as Report.post queues them and applied batch by batch through the
+# local task queue. run from the repository root with: python -m unittest discover -s tests -t .
+import datetime
+import unittest
+
+from tests.ladder_testbed import ladder, testbed, rating, Player, LadderTestCase
+
+class IngestTest(LadderTestCase):
+
+    def setUp(self):
+        LadderTestCase.setUp(self)
+        for i in range(5):
+            ladder.EnsureMembership(Player(i))
+        # an index to move, rather than one built from the records on its first read
+        ladder.GetRankIndex()
+
+    def QueueReport(self, date, winner, loser, tie, winnerScore, loserScore):
+        ladder.QueueReport(ladder.PendingReport(parent = ladder.GetReportParentKey(), ladder = ladder.ladder_name, date = date,
+                                                reporter = winner, winner = winner, loser = loser, tie = tie,
+                                                winner_score = winnerScore, loser_score = loserScore))
+
+    def testAppliesBatchesToTheFullReplay(self):
+        for game in self.MakeGames(22):
+            self.QueueReport(*game)
+        self.queue.RunTasks()
+
+        self.assertEqual(0, ladder.PendingReport.all().count())
+        games = self.GetGames()
+        self.assertEqual(22, len(games))
+        self.assertEqual([ladder.DERIVED_APPLIED] * 22, [game.derived for game in games])
+        replay = self.assertRecordsMatchReplay()
+
+        # the records derived from the ledgers
+        index = ladder.GetRankIndex()
+        self.assertEqual(rating.RankIndex.FromRatings([r for r in replay.rating if r]).tree, index.tree)
+        for player in replay.players:
+            played = [game for game in games if player in (game.winner, game.loser)]
+            history = ladder.RatingHistory.get(ladder.GetRatingHistoryKey(player))
+            self.assertEqual([game.date for game in played], history.dates)
+            self.assertEqual(replay.rating[replay.slots[player]], history.ratings[-1])
+        headToHead = ladder.HeadToHead.get_by_key_name(ladder.HeadToHeadKeyName(Player(0), Player(1)))
+        between = [game for game in games if set([game.winner, game.loser]) == set([Player(0), Player(1)])]
+        self.assertEqual(len(between), headToHead.wins + headToHead.draws + headToHead.losses)
+
+        # a checkpoint every CHECKPOINT_INTERVAL games, each the replay of the games up to it
+        checkpoints = list(ladder.RatingCheckpoint.all().filter("ladder =", ladder.ladder_name).order('numGames'))
+        self.assertEqual([5, 10, 15, 20], [checkpoint.numGames for checkpoint in checkpoints])
+        expected = rating.GetEngine('elo').NewReplay()
+        expected.Replay(games[:20])
+        actual = checkpoints[-1].get_replay()
+        for player in expected.players:
+            self.assertEqual(expected.PlayerStats(player), actual.PlayerStats(player))
+
+    def testSetsAsideAReportThatCannotBeApplied(self):
+        games = self.MakeGames(6)
+        for game in games[:2]:
+            self.QueueReport(*game)
+        stranger = ladder.users.User("stranger@example.com")
+        self.QueueReport(games[1][0] + datetime.timedelta(seconds = 30), Player(0), stranger, False, 3, 0)
+        for game in games[2:]:
+            self.QueueReport(*game)
+        self.queue.RunTasks()
+
+        failed = list(ladder.FailedReport.all())
+        self.assertEqual(1, len(failed))
+        self.assertEqual(stranger, failed[0].loser)
+        self.assertTrue("without a record" in failed[0].error)
+        self.assertEqual(0, ladder.PendingReport.all().count())
+        self.assertEqual(6, len(self.GetGames()))
+        self.assertEqual(None, ladder.GetUserRecord(stranger))
+        self.assertRecordsMatchReplay()
+
+IngestTest = unittest.skipIf(testbed is None, "App Engine SDK not found, set APPENGINE_SDK")(IngestTest)
+
+if __name__ == '__main__':
+    unittest.main()
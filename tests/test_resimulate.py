@@ -0,0 +1,75 @@
+# the background resimulation, run chunk by chunk through the local task queue.
+# run from the repository root with: python -m unittest discover -s tests -t .
+import unittest
+
+from tests.ladder_testbed import ladder, testbed, Player, LadderTestCase
+
+class ResimulateTest(LadderTestCase):
+
+    def setUp(self):
+        LadderTestCase.setUp(self)
+        # games as stored before the ledger existed, so the first resimulation writes every ledger
+        entities = [ladder.UserRecord.create_UserRecord(Player(i)) for i in range(5)]
+        for date, winner, loser, tie, winnerScore, loserScore in self.MakeGames(42):
+            entities.append(ladder.GameRecord(ladder = ladder.ladder_name, date = date, winner = winner, loser = loser, tie = tie,
+                                              winner_score = winnerScore, loser_score = loserScore, participants = [winner, loser]))
+        ladder.PutBatched(entities)
+
+    def testRunsEveryChunkToTheFullReplay(self):
+        ladder.StartResimulateJob()
+        # five chunks of up to ten games, the history task and nothing after it
+        self.assertEqual(6, self.queue.RunTasks())
+
+        job = ladder.ResimulateJob.get_by_key_name(ladder.ladder_name)
+        self.assertEqual('done', job.status)
+        self.assertEqual(42, job.gamesDone)
+        replay = self.assertRecordsMatchReplay()
+
+        checkpoints = list(ladder.RatingCheckpoint.all().filter("ladder =", ladder.ladder_name).order('numGames'))
+        self.assertEqual(range(5, 41, 5), [checkpoint.numGames for checkpoint in checkpoints])
+        self.assertEqual(len(replay.players), ladder.GetRankIndex().Total())
+        history = ladder.RatingHistory.get(ladder.GetRatingHistoryKey(Player(0)))
+        self.assertEqual(replay.rating[replay.slots[Player(0)]], history.ratings[-1])
+
+    def testResumesAfterAFailedChunk(self):
+        replayGames = ladder.ReplayGames
+        calls = []
+        def FailThirdChunk(replay, games, numGames):
+            calls.append(numGames)
+            if len(calls) == 3:
+                raise ladder.db.Timeout("chunk failed")
+            return replayGames(replay, games, numGames)
+        ladder.ReplayGames = FailThirdChunk
+        try:
+            ladder.StartResimulateJob()
+            self.assertRaises(ladder.db.Timeout, self.queue.RunTasks)
+            # the failed chunk stays queued and runs again from the checkpoint the job points at
+            self.assertEqual(1, len(self.queue.tasks))
+            self.queue.RunTasks()
+        finally:
+            ladder.ReplayGames = replayGames
+
+        self.assertEqual(calls[2], calls[3])
+        self.assertEqual('done', ladder.ResimulateJob.get_by_key_name(ladder.ladder_name).status)
+        self.assertRecordsMatchReplay()
+
+    def testRestartsFromACheckpoint(self):
+        ladder.StartResimulateJob()
+        self.queue.RunTasks()
+
+        # change a game past the first checkpoints, the replay starts from the one before it
+        game = self.GetGames()[27]
+        game.winner_score += 3
+        game.put()
+        job = ladder.StartResimulateJob(game.date)
+        self.assertEqual(25, job.numGames)
+        self.assertEqual(17, job.gamesTotal)
+        self.queue.RunTasks()
+
+        self.assertEqual(17, ladder.ResimulateJob.get_by_key_name(ladder.ladder_name).gamesDone)
+        self.assertRecordsMatchReplay()
+
+ResimulateTest = unittest.skipIf(testbed is None, "App Engine SDK not found, set APPENGINE_SDK")(ResimulateTest)
+
+if __name__ == '__main__':
+    unittest.main()